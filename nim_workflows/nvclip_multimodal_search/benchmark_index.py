@@ -0,0 +1,194 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+from pathlib import Path
+from time import perf_counter, sleep
+
+import numpy as np
+from pymilvus import MilvusClient
+
+from index_config import INDEX_TYPES, create_collection, search_params, default_metadata
+from export import export_collection
+
+
+def synthetic_vectors(n, dim, clusters=256, seed=0):
+    """Clustered random unit vectors. Uniform random vectors are unrealistically hard for ANN indexes."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, n)] + 0.5 * rng.standard_normal(
+        (n, dim)
+    ).astype(np.float32)
+    return vectors
+
+
+def load_vectors(db, collection_name):
+    """Vectors from an existing search collection"""
+    client = MilvusClient(db)
+    vectors, _ = export_collection(client, collection_name, str(Path(db).with_suffix(".export")), 1024)
+    return np.asarray(vectors)
+
+
+def normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def ground_truth(corpus, queries, k, block=1024):
+    """Exact cosine top-k by brute force"""
+    corpus = normalize(corpus)
+    queries = normalize(queries)
+    truth = []
+    for start in range(0, len(queries), block):
+        sims = queries[start : start + block] @ corpus.T
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        truth.extend(set(row) for row in top.tolist())
+    return truth
+
+
+def wait_for_index(client, name, rows, timeout=3600, poll=1.0):
+    """Block until the vector index covers all rows. Without this, fresh rows sit in growing segments and are searched by brute force."""
+    index_name = client.list_indexes(collection_name=name, field_name="vector")[0]
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        info = client.describe_index(collection_name=name, index_name=index_name)
+        if info.get("indexed_rows", rows) >= rows:  # Milvus Lite does not report progress
+            return
+        sleep(poll)
+    raise Exception(f"Index of {name} did not finish building within {timeout}s")
+
+
+def benchmark(client, index_type, corpus, queries, truth, k, build, search):
+    """Build one index over the corpus and time single query searches against it. Returns recall@k and latency percentiles in ms."""
+    name = f"benchmark_{index_type.lower()}"
+    if client.has_collection(name):
+        client.drop_collection(name)
+    create_collection(client, name, corpus.shape[1], index_type, build, scalar_indexes=False)
+
+    start = perf_counter()
+    for i in range(0, len(corpus), 5000):
+        batch = corpus[i : i + 5000]
+        client.insert(
+            collection_name=name,
+            data=[
+                {"id": i + j, "vector": v, "file_name": "", **default_metadata()}
+                for j, v in enumerate(batch)
+            ],
+        )
+    insert_time = perf_counter() - start
+
+    # seal the segments and wait for the index, so searches measure the index under test
+    start = perf_counter()
+    client.flush(name)
+    wait_for_index(client, name, len(corpus))
+    client.load_collection(name)
+    build_time = perf_counter() - start
+
+    params = search_params(index_type, search)
+    latencies, hits = [], 0
+    for q, expected in zip(queries, truth):
+        start = perf_counter()
+        res = client.search(
+            collection_name=name,
+            data=[q.tolist()],
+            limit=k,
+            search_params=params,
+            consistency_level="Strong",
+        )
+        latencies.append((perf_counter() - start) * 1000)
+        hits += len(expected & {x["id"] for x in res[0]})
+
+    client.drop_collection(name)
+    return {
+        "index": index_type,
+        "insert_s": insert_time,
+        "build_s": build_time,
+        f"recall@{k}": hits / (k * len(queries)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+if __name__ == "__main__":
+    """Compare recall and latency of the supported index types against brute force search"""
+    parser = argparse.ArgumentParser(description="NV-CLIP Index Benchmark")
+    parser.add_argument(
+        "--milvus_uri",
+        type=str,
+        default="http://localhost:19530",
+        help="Milvus server to benchmark on. Milvus Lite (a .db file) only supports FLAT",
+    )
+    parser.add_argument(
+        "--source_db",
+        type=str,
+        default=None,
+        help="Benchmark on the vectors of an existing search database instead of synthetic vectors",
+    )
+    parser.add_argument("--num_vectors", type=int, default=100_000, help="Synthetic corpus size")
+    parser.add_argument("--num_queries", type=int, default=1000, help="Number of queries")
+    parser.add_argument("--top_k", type=int, default=20, help="k for recall@k")
+    parser.add_argument(
+        "--index_types",
+        nargs="+",
+        default=list(INDEX_TYPES.keys()),
+        choices=list(INDEX_TYPES.keys()),
+        help="Index types to benchmark",
+    )
+    parser.add_argument(
+        "--index_params",
+        type=json.loads,
+        default={},
+        help='JSON build params per index type, e.g. \'{"HNSW": {"M": 32}, "IVF_PQ": {"m": 32}}\'',
+    )
+    parser.add_argument(
+        "--search_params",
+        type=json.loads,
+        default={},
+        help='JSON search params per index type, e.g. \'{"HNSW": {"ef": 128}, "IVF_FLAT": {"nprobe": 32}}\'',
+    )
+    args = parser.parse_args()
+    for params in (args.index_params, args.search_params):
+        unknown = set(params) - set(INDEX_TYPES)
+        if unknown:
+            raise Exception(f"Params must be keyed by index type, unknown keys: {sorted(unknown)}")
+
+    if args.source_db:
+        vectors = load_vectors(args.source_db, "collection")
+    else:
+        vectors = synthetic_vectors(args.num_vectors + args.num_queries, 1024)
+
+    # hold out queries from the corpus
+    rng = np.random.default_rng(1)
+    order = rng.permutation(len(vectors))
+    queries = vectors[order[: args.num_queries]]
+    corpus = vectors[order[args.num_queries :]]
+    print(f"corpus: {len(corpus)} vectors, {len(queries)} queries")
+
+    truth = ground_truth(corpus, queries, args.top_k)
+    client = MilvusClient(args.milvus_uri)
+    for index_type in args.index_types:
+        result = benchmark(
+            client,
+            index_type,
+            corpus,
+            queries,
+            truth,
+            args.top_k,
+            args.index_params.get(index_type),
+            args.search_params.get(index_type),
+        )
+        print(
+            "  ".join(f"{k}={v:.4f}" if isinstance(v, float) else f"{k}={v}" for k, v in result.items())
+        )
@@ -0,0 +1,251 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from projection import _signature
+
+
+def dedup_path_for(db_name):
+    """Duplicate clusters are cached next to the Milvus Lite db file."""
+    return str(Path(db_name).with_suffix(".dedup.npz"))
+
+
+def dhash(path, size=8, min_gradient_std=2.0):
+    """Difference hash of an image as a hex string. Re-encoded or resized copies of an image get the same hash.
+    Returns None for uniform or low contrast images (e.g. black frames, dark night shots). Their gradients are noise, so
+    unrelated images of that kind would share a hash."""
+    image = Image.open(path)
+    image.draft("L", (size * 8, size * 8))
+    image = image.convert("L").resize((size + 1, size), Image.BILINEAR)
+    pixels = np.asarray(image, dtype=np.int16)
+    gradients = pixels[:, 1:] - pixels[:, :-1]
+    if gradients.std() < min_gradient_std:
+        return None
+    return np.packbits(gradients > 0).tobytes().hex()
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def similar_pairs(vectors, threshold, rows=None, block=2048):
+    """Yield (row, row) pairs with cosine similarity >= threshold by blocked matrix multiplication, so memory stays at block x block.
+    Without rows every pair is compared once. With rows only those rows are compared against all vectors."""
+    n = len(vectors)
+    if rows is None:
+        for i in range(0, n, block):
+            a = _normalize(vectors[i : i + block])
+            for j in range(i, n, block):
+                b = a if j == i else _normalize(vectors[j : j + block])
+                sims = a @ b.T
+                if j == i:  # each pair once and no self matches
+                    sims = np.triu(sims, k=1)
+                r, c = np.nonzero(sims >= threshold)
+                yield from zip((r + i).tolist(), (c + j).tolist())
+        return
+
+    rows = np.asarray(rows)
+    for i in range(0, len(rows), block):
+        query_rows = rows[i : i + block]
+        a = _normalize(vectors[query_rows])
+        for j in range(0, n, block):
+            sims = a @ _normalize(vectors[j : j + block]).T
+            r, c = np.nonzero(sims >= threshold)
+            for q, row in zip(query_rows[r].tolist(), (c + j).tolist()):
+                if q != row:
+                    yield q, row
+
+
+def similar_pairs_ann(client, collection_name, ids, vectors, threshold, rows=None, k=16, batch=256, search_params=None):
+    """Yield (id, id) pairs from a k nearest neighbour search on the vector index. Used for collections too large for the
+    all pairs matmul. Each vector only links to its k nearest neighbours, which is enough to connect a cluster."""
+    rows = np.arange(len(ids)) if rows is None else np.asarray(rows)
+    for start in range(0, len(rows), batch):
+        batch_rows = rows[start : start + batch]
+        results = client.search(
+            collection_name=collection_name,
+            data=np.asarray(vectors[batch_rows], dtype=np.float32).tolist(),
+            anns_field="vector",
+            limit=k,
+            search_params=search_params or {},
+        )
+        for row, hits in zip(batch_rows.tolist(), results):
+            for hit in hits:
+                if hit["id"] != ids[row] and hit["distance"] >= threshold:
+                    yield ids[row], hit["id"]
+
+
+class UnionFind:
+    """Disjoint sets over ids. The smallest id of a set is its root, so representatives do not depend on insertion order."""
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        root = x
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        while self.parent.get(x, x) != root:  # path compression
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+
+class DuplicateClusters:
+
+    def __init__(self, threshold=0.95, max_exact=100_000, block=2048):
+        """Clusters of near duplicate images. Every member has a cosine similarity >= threshold to the center of its cluster,
+        so a slowly changing sequence of frames does not chain into one cluster. Up to max_exact vectors are compared exactly,
+        larger collections use the ANN index of the collection."""
+        if not 0 < threshold <= 1:
+            raise Exception(f"Duplicate threshold must be in (0, 1], got {threshold}")
+        self.threshold = threshold
+        self.max_exact = max_exact
+        self.block = block
+        self.sets = UnionFind()
+        self.center = {}  # root -> id of the image the members were compared with, singletons are their own center
+        self.size = {}  # root -> number of members, singletons are not stored
+
+    def _join(self, a, b):
+        """Merge the clusters of a and b. The center of a (if it has members) is the center of the result."""
+        center = self.center.get(self.sets.find(a), a)
+        size = self.size.get(self.sets.find(a), 1) + self.size.get(self.sets.find(b), 1)
+        for root in (self.sets.find(a), self.sets.find(b)):
+            self.center.pop(root, None)
+            self.size.pop(root, None)
+        self.sets.union(a, b)
+        root = self.sets.find(a)
+        self.center[root] = center
+        self.size[root] = size
+
+    def _link(self, a, b, vector_of):
+        """Add a near duplicate pair. A single image joins a cluster only if it is also close to the cluster's center, two
+        clusters with several members are never merged."""
+        root_a, root_b = self.sets.find(a), self.sets.find(b)
+        if root_a == root_b:
+            return
+        if self.size.get(root_a, 1) > 1 and self.size.get(root_b, 1) > 1:
+            return
+        if self.size.get(root_a, 1) == 1:  # b's side has the center
+            a, b, root_a, root_b = b, a, root_b, root_a
+        center = self.center.get(root_a, a)
+        single = b
+        center_vector, single_vector = vector_of(center), vector_of(single)
+        if center_vector is None or single_vector is None:
+            return
+        if float(_normalize(center_vector[None])[0] @ _normalize(single_vector[None])[0]) >= self.threshold:
+            self._join(a, b)
+
+    def representative(self, id):
+        return self.sets.find(id)
+
+    def update(self, ids, vectors, rows=None, client=None, collection_name="collection", search_params=None):
+        """Link the given rows (all rows if None) to their near duplicates among the vectors"""
+        ids = [int(x) for x in ids]
+        row_of_id = {id: row for row, id in enumerate(ids)}
+
+        def vector_of(id):
+            row = row_of_id.get(id)
+            return None if row is None else np.asarray(vectors[row], dtype=np.float32)
+
+        if client is not None and len(ids) > self.max_exact:
+            pairs = similar_pairs_ann(
+                client, collection_name, ids, vectors, self.threshold, rows=rows, search_params=search_params
+            )
+        else:
+            pairs = ((ids[a], ids[b]) for a, b in similar_pairs(vectors, self.threshold, rows=rows, block=self.block))
+        for a, b in pairs:
+            self._link(a, b, vector_of)
+        return self
+
+    def collapse(self, hits, limit=None):
+        """Keep the best hit of each cluster. hits are (file_name, id, score) tuples, best first."""
+        seen = set()
+        collapsed = []
+        for hit in hits:
+            representative = self.representative(hit[1])
+            if representative not in seen:
+                seen.add(representative)
+                collapsed.append(hit)
+        return collapsed[:limit]
+
+    def save(self, dedup_path, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64)
+        np.savez(
+            dedup_path,
+            ids=ids,
+            representative=np.array([self.representative(x) for x in ids.tolist()], dtype=np.int64),
+            center=np.array([self.center.get(self.sets.find(x), x) for x in ids.tolist()], dtype=np.int64),
+            signature=_signature(vectors),
+            threshold=self.threshold,
+        )
+
+    @classmethod
+    def load_or_build(cls, dedup_path, ids, vectors, threshold=0.95, **kwargs):
+        """Clusters for the vectors, reusing the cached clusters where possible. Only points that are new or whose vector
+        changed since the clusters were saved are compared against the collection. kwargs are passed to update."""
+        clusters = cls(threshold)
+        ids = np.asarray(ids, dtype=np.int64)
+
+        cached = None
+        if os.path.exists(dedup_path):
+            with np.load(dedup_path) as f:
+                cached = {key: f[key] for key in f.files}
+        if cached is None or float(cached["threshold"]) != threshold or "center" not in cached:
+            print("finding near duplicate images")
+            clusters.update(ids, vectors, **kwargs)
+            clusters.save(dedup_path, ids, vectors)
+            return clusters
+
+        row_of_id = {id: row for row, id in enumerate(cached["ids"].tolist())}
+        cached_rows = np.array([row_of_id.get(id, -1) for id in ids.tolist()], dtype=np.int64)
+        known = cached_rows >= 0
+        known[known] = np.all(
+            np.isclose(_signature(vectors[known]), cached["signature"][cached_rows[known]], rtol=1e-5, atol=1e-5),
+            axis=1,
+        )
+
+        # restore the cached clusters around their centers. Members of a cluster whose center was removed or changed are checked again
+        members = {}
+        for id, representative in zip(ids[known].tolist(), cached["representative"][cached_rows[known]].tolist()):
+            members.setdefault(representative, []).append(id)
+        known_ids = set(ids[known].tolist())
+        center_of = dict(zip(cached["ids"].tolist(), cached["center"].tolist()))
+        position = {id: i for i, id in enumerate(ids.tolist())}
+        for group in members.values():
+            center = center_of[group[0]]
+            if center not in known_ids:  # the members are compared again below
+                known[[position[id] for id in group]] = False
+                continue
+            for id in group:
+                if id != center:
+                    clusters._join(center, id)
+
+        rows = np.nonzero(~known)[0]
+        if len(rows) > 0:
+            print(f"checking {len(rows)} new images for near duplicates")
+            clusters.update(ids, vectors, rows=rows, **kwargs)
+        clusters.save(dedup_path, ids, vectors)
+        return clusters
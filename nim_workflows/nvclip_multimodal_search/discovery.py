@@ -0,0 +1,118 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import hashlib
+from itertools import islice
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp"}
+VIDEO_EXTENSIONS = {".mp4", ".mov", ".avi", ".mkv", ".webm"}
+
+
+class ImagePath(str):
+    """Path to a local image file. NVCLIP sends it as an image without checking the filesystem."""
+
+
+class Text(str):
+    """Text to embed. Never treated as a file path, even if a file with that name exists."""
+
+
+def is_file_item(item):
+    """True if a string to embed refers to a local file. Typed items are answered without touching the filesystem."""
+    if isinstance(item, ImagePath):
+        return True
+    if isinstance(item, Text):
+        return False
+    return os.path.isfile(item)
+
+
+def file_hash(path):
+    """sha256 of the file content"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def has_image_extension(path):
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def has_image_magic(path):
+    """Check the first bytes of the file against the signatures of the supported formats"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(12)
+    except OSError:
+        return False
+    return (
+        head.startswith(b"\xff\xd8\xff")  # jpeg
+        or head.startswith(b"\x89PNG\r\n\x1a\n")
+        or head.startswith(b"BM")
+        or (head.startswith(b"RIFF") and head[8:12] == b"WEBP")
+    )
+
+
+def is_image(path):
+    return has_image_extension(path) and has_image_magic(path)
+
+
+def walk_files(folder, accept, follow_symlinks=False, exclude=()):
+    """Recursively yield (path, stat) for every file under folder for which accept(path) is true. Directories are read lazily
+    with os.scandir, so the walk starts yielding immediately and never holds a full listing of the tree in memory.
+    Directories in exclude are skipped, e.g. keyframes or thumbnails the app writes inside the folder."""
+    exclude = {os.path.abspath(x) for x in exclude}
+    stack = [str(folder)]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=follow_symlinks):
+                            if os.path.abspath(entry.path) not in exclude:
+                                stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=follow_symlinks) and accept(entry.path):
+                            yield entry.path, entry.stat(follow_symlinks=follow_symlinks)
+                    except OSError as e:  # file removed during the walk
+                        print(f"Skipping {entry.path}: {e}")
+        except OSError as e:
+            print(f"Could not read directory {directory}: {e}")
+
+
+def walk_images(folder, check_magic=True, follow_symlinks=False, exclude=()):
+    """Recursively yield (ImagePath, stat) for every image under folder, skipping the directories in exclude.
+    With check_magic=False files are only filtered by extension, which avoids opening every file."""
+    accept = is_image if check_magic else has_image_extension
+    for path, st in walk_files(folder, accept, follow_symlinks, exclude):
+        yield ImagePath(path), st
+
+
+def walk_videos(folder, follow_symlinks=False):
+    """Recursively yield (path, stat) for every video file under folder"""
+    return walk_files(
+        folder, lambda path: os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS, follow_symlinks
+    )
+
+
+def iter_image_batches(folder, batch_size=64, check_magic=True):
+    """Yield lists of up to batch_size ImagePaths, e.g. one NVCLIP request each"""
+    paths = (path for path, _ in walk_images(folder, check_magic=check_magic))
+    while True:
+        batch = list(islice(paths, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
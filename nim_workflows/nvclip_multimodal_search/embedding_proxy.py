@@ -0,0 +1,224 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import asyncio
+import json
+from contextlib import asynccontextmanager
+
+import aiohttp
+import uvicorn
+from fastapi import FastAPI, HTTPException, Body
+
+from concurrency import AdaptiveConcurrency, request_with_retry_async
+
+
+class _Pending:
+    """One caller's request waiting to be batched"""
+
+    def __init__(self, key, params, inputs, future):
+        self.key = key
+        self.params = params
+        self.inputs = inputs
+        self.future = future
+
+
+class MicroBatcher:
+
+    def __init__(self, upstream_url, api_key, max_batch=64, max_wait_ms=5.0, concurrency=16, controller=None):
+        """Merge concurrent embedding requests into upstream requests of up to max_batch inputs. A batch is sent when it is full or
+        max_wait_ms after its first request arrived. Only requests with the same parameters (model, encoding_format, ...) are merged."""
+        self.upstream_url = upstream_url
+        self.headers = {"Authorization": f"Bearer {api_key}", "Accept": "application/json"}
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.concurrency = concurrency
+        self.controller = AdaptiveConcurrency() if controller is None else controller
+        self.stats = {"requests": 0, "inputs": 0, "upstream_requests": 0}
+        self.queue = None
+        self.session = None
+        self.semaphore = None
+        self.task = None
+        self.sending = set()
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(headers=self.headers, connector=connector)
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        self.task.cancel()
+        for task in list(self.sending):
+            task.cancel()
+        await self.session.close()
+
+    async def embed(self, body):
+        """Embed the inputs of one /v1/embeddings request body. Returns the embeddings in input order and the upstream model name."""
+        inputs = body.get("input")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        if not isinstance(inputs, list) or len(inputs) == 0:
+            raise HTTPException(status_code=400, detail="input must be a string or a non-empty list")
+        params = {k: v for k, v in body.items() if k != "input"}
+        key = json.dumps(params, sort_keys=True)
+        self.stats["requests"] += 1
+        self.stats["inputs"] += len(inputs)
+
+        # requests larger than a batch are split, the parts can still share batches with other callers
+        loop = asyncio.get_running_loop()
+        parts = []
+        for i in range(0, len(inputs), self.max_batch):
+            future = loop.create_future()
+            self.queue.put_nowait(_Pending(key, params, inputs[i : i + self.max_batch], future))
+            parts.append(future)
+        results = await asyncio.gather(*parts)
+        return [x for embeddings, _ in results for x in embeddings], results[0][1]
+
+    async def _run(self):
+        """Collect requests for one wait window at a time and hand each batch to a sender task"""
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self.queue.get()
+            groups = {first.key: [first]}
+            deadline = loop.time() + self.max_wait
+            while True:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                group = groups.setdefault(item.key, [])
+                if sum(len(x.inputs) for x in group) + len(item.inputs) > self.max_batch:
+                    self._send(group)  # full, send it now and start a new batch with this request
+                    groups[item.key] = group = []
+                group.append(item)
+            for group in groups.values():
+                if len(group) > 0:
+                    self._send(group)
+
+    def _send(self, group):
+        task = asyncio.create_task(self._post(group))
+        self.sending.add(task)
+        task.add_done_callback(self.sending.discard)
+
+    async def _request(self, group):
+        """Send the inputs of a group as one upstream request. Returns the embeddings in input order and the model name."""
+        payload = {**group[0].params, "input": [x for item in group for x in item.inputs]}
+        async with self.semaphore:
+            self.stats["upstream_requests"] += 1
+            response = await request_with_retry_async(
+                self.controller, self.session, "post", self.upstream_url, json=payload
+            )
+        embeddings = [x["embedding"] for x in sorted(response["data"], key=lambda x: x["index"])]
+        if len(embeddings) != len(payload["input"]):
+            raise Exception(f"Expected {len(payload['input'])} embeddings, received {len(embeddings)}")
+        return embeddings, response.get("model")
+
+    async def _post(self, group):
+        """Send one merged request and give each caller its own rows. If upstream rejects a merged request with a 4xx, one caller's
+        inputs may be to blame, so each caller is retried on its own and only the bad ones get the error."""
+        try:
+            embeddings, model = await self._request(group)
+        except aiohttp.ClientResponseError as e:
+            if len(group) > 1 and 400 <= e.status < 500:
+                await asyncio.gather(*(self._post([item]) for item in group))
+                return
+            self._fail(group, e)
+            return
+        except Exception as e:
+            self._fail(group, e)
+            return
+
+        start = 0
+        for item in group:
+            if not item.future.done():  # caller may have disconnected
+                item.future.set_result((embeddings[start : start + len(item.inputs)], model))
+            start += len(item.inputs)
+
+    def _fail(self, group, e):
+        for item in group:
+            if not item.future.done():
+                item.future.set_exception(e)
+
+
+def create_app(batcher):
+    """FastAPI app with the same request and response shape as the NIM /v1/embeddings endpoint"""
+
+    @asynccontextmanager
+    async def lifespan(app):
+        await batcher.start()
+        yield
+        await batcher.close()
+
+    app = FastAPI(lifespan=lifespan)
+
+    async def embeddings(body: dict = Body(...)):
+        try:
+            embeddings, model = await batcher.embed(body)
+        except aiohttp.ClientResponseError as e:
+            raise HTTPException(status_code=e.status, detail=e.message)
+        except aiohttp.ClientError as e:
+            raise HTTPException(status_code=502, detail=str(e))
+        return {
+            "object": "list",
+            "data": [
+                {"object": "embedding", "index": i, "embedding": x} for i, x in enumerate(embeddings)
+            ],
+            "model": model or body.get("model"),
+            "usage": {"num_images": 0, "prompt_tokens": 0, "total_tokens": 0},  # usage is only known per merged batch
+        }
+
+    async def stats():
+        return batcher.stats
+
+    app.post("/v1/embeddings")(embeddings)
+    app.get("/stats")(stats)
+    return app
+
+
+if __name__ == "__main__":
+    """Local embedding proxy. Point NVCLIP base_url (or --nvclip_url) at http://localhost:<port>/v1/embeddings
+    so that concurrent single item requests share upstream calls."""
+    parser = argparse.ArgumentParser(description="NV-CLIP Micro-Batching Proxy")
+    parser.add_argument("api_key", type=str, help="NVIDIA NIM API Key used for the upstream requests")
+    parser.add_argument(
+        "--upstream_url",
+        type=str,
+        default="https://integrate.api.nvidia.com/v1/embeddings",
+        help="URL to NV-CLIP NIM",
+    )
+    parser.add_argument("--port", type=int, default=8010, help="Port to serve the proxy on")
+    parser.add_argument("--max_batch", type=int, default=64, help="Maximum inputs per upstream request")
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=5.0,
+        help="How long the first request of a batch waits for others to join",
+    )
+    parser.add_argument("--concurrency", type=int, default=16, help="Maximum upstream requests in flight")
+    args = parser.parse_args()
+
+    batcher = MicroBatcher(
+        args.upstream_url,
+        args.api_key,
+        max_batch=args.max_batch,
+        max_wait_ms=args.max_wait_ms,
+        concurrency=args.concurrency,
+    )
+    uvicorn.run(create_app(batcher), host="localhost", port=args.port, log_level="info")
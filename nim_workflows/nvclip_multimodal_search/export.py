@@ -0,0 +1,123 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def iter_collection(client, collection_name, output_fields, batch_size=1000, filter=""):
+    """Yield every row of a collection in batches of batch_size. Avoids the result size limit of a single query."""
+    iterator = client.query_iterator(
+        collection_name=collection_name,
+        batch_size=batch_size,
+        filter=filter,
+        output_fields=output_fields,
+    )
+    try:
+        while True:
+            batch = iterator.next()
+            if len(batch) == 0:
+                break
+            yield batch
+    finally:
+        iterator.close()
+
+
+def export_collection(
+    client,
+    collection_name,
+    out_prefix,
+    dim,
+    pk_field="id",
+    vector_field="vector",
+    metadata_fields=(),
+    batch_size=1000,
+):
+    """Stream a collection to <out_prefix>.vectors.f32 (row major float32) and <out_prefix>.meta.parquet (primary key and metadata).
+    Row i of the parquet file describes row i of the vectors. Returns the vectors as a read only memmap and the metadata as an arrow table."""
+    Path(out_prefix).parent.mkdir(parents=True, exist_ok=True)
+    vector_path = f"{out_prefix}.vectors.f32"
+    meta_path = f"{out_prefix}.meta.parquet"
+    columns = [pk_field] + list(metadata_fields)
+
+    writer = None
+    with open(vector_path, "wb") as vector_file:
+        for batch in iter_collection(
+            client, collection_name, columns + [vector_field], batch_size=batch_size
+        ):
+            np.asarray([x[vector_field] for x in batch], dtype=np.float32).tofile(vector_file)
+            table = pa.table({c: [x[c] for x in batch] for c in columns})
+            if writer is None:
+                writer = pq.ParquetWriter(meta_path, table.schema)
+            writer.write_table(table)
+
+    if writer is None:  # empty collection
+        pq.write_table(pa.table({c: [] for c in columns}), meta_path)
+    else:
+        writer.close()
+
+    return load_export(out_prefix, dim)
+
+
+def load_export(out_prefix, dim):
+    """Open a previous export without loading the vectors into memory"""
+    meta = pq.read_table(f"{out_prefix}.meta.parquet")
+    vector_path = f"{out_prefix}.vectors.f32"
+    if meta.num_rows == 0:
+        return np.zeros((0, dim), dtype=np.float32), meta
+    if os.path.getsize(vector_path) != meta.num_rows * dim * 4:
+        raise Exception(f"Export at {out_prefix} is incomplete")
+    vectors = np.memmap(vector_path, dtype=np.float32, mode="r", shape=(meta.num_rows, dim))
+    return vectors, meta
+
+
+class VectorFile:
+
+    def __init__(self, path, dim):
+        """Row major float32 vectors in a file, read through a read only memory map. Rows can be appended and overwritten in place,
+        so the set of vectors can grow without ever being held in memory."""
+        self.path = str(path)
+        self.dim = dim
+        Path(self.path).touch(exist_ok=True)
+        self.vectors = self._open()
+
+    def _open(self):
+        rows = os.path.getsize(self.path) // (4 * self.dim)
+        if rows == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.memmap(self.path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def append(self, vectors):
+        """Add rows at the end. Readers holding the previous memory map keep seeing the old rows."""
+        if len(vectors) == 0:
+            return
+        with open(self.path, "ab") as f:
+            np.asarray(vectors, dtype=np.float32).tofile(f)
+        self.vectors = self._open()
+
+    def update(self, rows, vectors):
+        """Overwrite existing rows"""
+        if len(rows) == 0:
+            return
+        writable = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(len(self.vectors), self.dim))
+        writable[rows] = vectors
+        writable.flush()
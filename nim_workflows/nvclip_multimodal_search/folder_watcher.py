@@ -0,0 +1,135 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from queue import Queue, Empty
+from threading import Thread, Event
+from time import time
+
+try:  # inotify on linux. Falls back to polling the folder if watchdog is not installed or has no inotify backend
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+from discovery import ImagePath, is_image, walk_images
+
+
+class _EventHandler(FileSystemEventHandler):
+    """Forward finished image files from watchdog to the batch queue"""
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_closed(self, event):  # file closed after writing, only reported by inotify
+        if not event.is_directory:
+            self.watcher._submit(event.src_path)
+
+    def on_moved(self, event):  # files moved into the folder are complete
+        if not event.is_directory:
+            self.watcher._submit(event.dest_path)
+
+
+class FolderWatcher:
+
+    def __init__(self, folder, on_batch, batch_size=64, max_wait=2.0, poll_interval=2.0, exclude=()):
+        """Watch a folder tree for new images and call on_batch(paths) with up to batch_size paths at a time.
+        A batch is sent once it is full or max_wait seconds after its first file arrived. Files in the directories in exclude are ignored."""
+        self.folder = folder
+        self.exclude = [os.path.abspath(x) for x in exclude]
+        self.on_batch = on_batch
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+
+        self.queue = Queue()
+        self.stopped = Event()
+        self.ready = Event()  # batches are held back until set
+        self.observer = None
+        self.threads = []
+
+    def _submit(self, path):
+        path = str(path)
+        if any(os.path.abspath(path).startswith(x + os.sep) for x in self.exclude):
+            return
+        if is_image(path):
+            self.queue.put(ImagePath(path))
+
+    def _poll(self):
+        """Fallback when inotify is not available. The folder tree is rescanned and new files are submitted once their size is stable between two scans."""
+        known = {path for path, _ in walk_images(self.folder, check_magic=False, exclude=self.exclude)}
+        pending = {}
+        while not self.stopped.wait(self.poll_interval):
+            for path, st in walk_images(self.folder, check_magic=False, exclude=self.exclude):
+                if path in known:
+                    continue
+                if pending.get(path) == st.st_size:
+                    known.add(path)
+                    del pending[path]
+                    self._submit(path)
+                else:
+                    pending[path] = st.st_size
+
+    def _batch(self):
+        """Group queued paths into micro batches"""
+        while not self.ready.wait(0.5):  # files found while paused stay queued
+            if self.stopped.is_set():
+                return
+        while not self.stopped.is_set():
+            try:
+                batch = [self.queue.get(timeout=0.5)]
+            except Empty:
+                continue
+            deadline = time() + self.max_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time())))
+                except Empty:
+                    break
+
+            batch = list(dict.fromkeys(batch))  # drop repeated events, keep order
+            try:
+                self.on_batch(batch)
+            except Exception as e:  # keep watching if one batch fails
+                print(f"Failed to ingest batch of {len(batch)} files: {e}")
+
+    def start(self, paused=False):
+        """Start watching. With paused=True new files are queued but on_batch is not called before resume(), e.g. while the app
+        is still starting up. Watching before the startup sync makes sure no file added during startup is missed."""
+        if not paused:
+            self.ready.set()
+        # only inotify reports closed files, the other watchdog backends would see a file before it is fully written
+        if Observer is not None and Observer.__name__ == "InotifyObserver":
+            self.observer = Observer()
+            self.observer.schedule(_EventHandler(self), self.folder, recursive=True)
+            self.observer.start()
+        else:
+            print("inotify not available, polling for new files")
+            self.threads.append(Thread(target=self._poll, daemon=True))
+        self.threads.append(Thread(target=self._batch, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def resume(self):
+        self.ready.set()
+
+    def stop(self):
+        self.stopped.set()
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        for thread in self.threads:
+            thread.join()
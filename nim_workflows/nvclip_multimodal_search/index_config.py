@@ -0,0 +1,131 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+from pymilvus import MilvusClient, DataType, MilvusException
+
+# default (build params, search params) for each supported index type
+INDEX_TYPES = {
+    "FLAT": ({}, {}),
+    "IVF_FLAT": ({"nlist": 1024}, {"nprobe": 16}),
+    "IVF_PQ": ({"nlist": 1024, "m": 64, "nbits": 8}, {"nprobe": 16}),
+    "HNSW": ({"M": 16, "efConstruction": 200}, {"ef": 64}),
+}
+METRIC = "COSINE"
+CODE_FIELD = "code"  # sign bit of every dimension, only in collections created for quantized search
+
+# scalar fields filled by metadata.extract_metadata and the index built on each
+METADATA_FIELDS = {
+    "capture_time": (DataType.INT64, {}, "STL_SORT"),
+    "camera": (DataType.VARCHAR, {"max_length": 256}, "INVERTED"),
+    "folder": (DataType.VARCHAR, {"max_length": 4096}, "INVERTED"),
+    "width": (DataType.INT32, {}, "STL_SORT"),
+    "height": (DataType.INT32, {}, "STL_SORT"),
+    "file_size": (DataType.INT64, {}, "STL_SORT"),
+}
+
+
+def default_metadata():
+    """Metadata of a row without a source image"""
+    return {
+        name: "" if datatype == DataType.VARCHAR else 0
+        for name, (datatype, _, _) in METADATA_FIELDS.items()
+    }
+
+
+def build_params(index_type, params=None):
+    """Index build params. User params override the defaults."""
+    return {**INDEX_TYPES[index_type][0], **(params or {})}
+
+
+def search_params(index_type, params=None):
+    """Search params for MilvusClient.search. User params override the defaults."""
+    return {"metric_type": METRIC, "params": {**INDEX_TYPES[index_type][1], **(params or {})}}
+
+
+def collection_index_type(client, collection_name, field_name="vector"):
+    """Index type of the vector field of an existing collection. It can differ from the --index_type given on later runs.
+    Unknown or automatic index types fall back to FLAT, which has no search params."""
+    for index_name in client.list_indexes(collection_name=collection_name, field_name=field_name):
+        index_type = client.describe_index(collection_name=collection_name, index_name=index_name).get("index_type")
+        if index_type in INDEX_TYPES:
+            return index_type
+    return "FLAT"
+
+
+def create_collection(
+    client, collection_name, dim, index_type="FLAT", params=None, scalar_indexes=True, binary_codes=False
+):
+    """Create the image collection with an explicit schema and the requested vector index. Metadata fields get scalar indexes so
+    filtered searches do not scan every row. Note that Milvus Lite always uses a FLAT index and does not support scalar indexes,
+    pass scalar_indexes=False for it. With binary_codes the collection also stores the sign bits of each vector with a HAMMING
+    index, so quantized search can run filtered searches without the float vectors loaded (see load_without_vectors)."""
+    schema = MilvusClient.create_schema(auto_id=False, enable_dynamic_field=True)
+    schema.add_field(field_name="id", datatype=DataType.INT64, is_primary=True)
+    schema.add_field(field_name="vector", datatype=DataType.FLOAT_VECTOR, dim=dim)
+    schema.add_field(field_name="file_name", datatype=DataType.VARCHAR, max_length=4096)
+    for name, (datatype, kwargs, _) in METADATA_FIELDS.items():
+        schema.add_field(field_name=name, datatype=datatype, **kwargs)
+
+    index_params = client.prepare_index_params()
+    index_params.add_index(
+        field_name="vector",
+        index_type=index_type,
+        metric_type=METRIC,
+        params=build_params(index_type, params),
+    )
+    if binary_codes:
+        schema.add_field(field_name=CODE_FIELD, datatype=DataType.BINARY_VECTOR, dim=dim)
+        index_params.add_index(field_name=CODE_FIELD, index_type="BIN_FLAT", metric_type="HAMMING")
+    if scalar_indexes:
+        for name, (_, _, scalar_index_type) in METADATA_FIELDS.items():
+            index_params.add_index(field_name=name, index_type=scalar_index_type)
+    client.create_collection(
+        collection_name=collection_name, schema=schema, index_params=index_params
+    )
+
+
+def has_binary_codes(client, collection_name):
+    """True if the collection was created with binary_codes"""
+    fields = client.describe_collection(collection_name=collection_name)["fields"]
+    return any(x["name"] == CODE_FIELD for x in fields)
+
+
+def binary_codes(vectors):
+    """Values of the code field, one sign bit per dimension packed 8 per byte"""
+    return [x.tobytes() for x in np.packbits(np.asarray(vectors) > 0, axis=1)]
+
+
+def load_without_vectors(client, collection_name):
+    """Reload a collection created with binary_codes without its float vector field, so Milvus only holds the binary codes and
+    the scalar fields in memory. Filters, queries and searches on the codes keep working. Returns False and loads every field
+    if the server cannot load a subset of the fields (e.g. Milvus Lite)."""
+    client.release_collection(collection_name=collection_name)
+    try:
+        client.load_collection(
+            collection_name=collection_name,
+            load_fields=["id", CODE_FIELD, "file_name", *METADATA_FIELDS],
+        )
+        return True
+    except MilvusException as e:
+        print(f"could not load the collection without its float vectors, loading all fields: {e}")
+        client.load_collection(collection_name=collection_name)
+        return False
+
+
+def load_all_fields(client, collection_name):
+    """Undo load_without_vectors, e.g. when a previous run left the collection loaded without its float vectors"""
+    client.release_collection(collection_name=collection_name)
+    client.load_collection(collection_name=collection_name)
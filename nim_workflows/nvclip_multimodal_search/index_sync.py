@@ -0,0 +1,307 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+from pathlib import Path
+
+import numpy as np
+
+from export import iter_collection
+from discovery import walk_images, has_image_magic, file_hash
+from dedup import dhash
+from metadata import extract_metadata
+from index_config import CODE_FIELD, binary_codes, has_binary_codes
+
+
+def manifest_path_for(db_name):
+    """The manifest is stored next to the Milvus Lite db file."""
+    return str(Path(db_name).with_suffix(".manifest.json"))
+
+
+def generated_dirs_for(db_name):
+    """Folders of keyframes and thumbnails written next to the db file. They are excluded from the image folder in case they end up inside it."""
+    return [str(Path(db_name).with_suffix(suffix)) for suffix in (".keyframes", ".thumbnails")]
+
+
+def load_manifest(manifest_path):
+    """Load the manifest mapping each indexed file to its size, mtime, content hash and primary key."""
+    if not os.path.exists(manifest_path):
+        return {"next_id": 0, "entries": {}}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_path, manifest):
+    """Write to a temp file and rename so a crash never leaves a half written manifest."""
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def diff_folder(image_folder, manifest, exclude=(), digests=None):
+    """Compare the folder tree against the manifest. Files whose size and mtime match are assumed unchanged, otherwise the content hash decides.
+    Only new or modified files are opened to check that they really are images. Directories in exclude are not searched.
+    The content hashes computed on the way are stored in digests (path -> file_hash) if it is given.
+    Returns lists of added, changed and removed paths."""
+    entries = manifest["entries"]
+
+    seen = set()
+    added, changed = [], []
+    for path, st in walk_images(image_folder, check_magic=False, exclude=exclude):
+        seen.add(path)
+        entry = entries.get(path)
+        if entry is not None and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+            continue
+        if not has_image_magic(path):
+            continue
+        if entry is None:
+            added.append(path)
+        else:
+            digest = file_hash(path)
+            if digest == entry["hash"]:  # touched but not modified
+                entry["size"], entry["mtime"] = st.st_size, st.st_mtime
+                continue
+            if digests is not None:
+                digests[path] = digest
+            changed.append(path)
+
+    removed = [path for path, entry in entries.items() if path not in seen and "id" in entry]  # video entries are synced separately
+    return added, changed, removed
+
+
+def make_rows(ids, paths, vectors, metadata=None, with_codes=False):
+    """Milvus rows for a set of embedded images, including the scalar metadata of each file. metadata is an optional dict per row
+    that overrides or adds (dynamic) fields. with_codes adds the binary code of each vector. All rows written to the collection are built here."""
+    rows = [
+        {"id": int(id), "vector": vector, "file_name": str(path), **extract_metadata(path)}
+        for id, path, vector in zip(ids, paths, vectors)
+    ]
+    for row, extra in zip(rows, metadata or []):
+        row.update(extra)
+    if with_codes:
+        for row, code in zip(rows, binary_codes(vectors)):
+            row[CODE_FIELD] = code
+    return rows
+
+
+def upsert_rows(client, collection_name, ids, paths, vectors, metadata=None):
+    """Write embedded images to the collection. Collections created with binary codes also get the code of each vector."""
+    with_codes = has_binary_codes(client, collection_name)
+    client.upsert(collection_name=collection_name, data=make_rows(ids, paths, vectors, metadata, with_codes))
+
+
+def fetch_vectors(client, ids, collection_name="collection"):
+    """Stored vectors of the given ids. Returns a dict from id to vector."""
+    rows = client.get(collection_name=collection_name, ids=list(ids), output_fields=["vector"])
+    return {x["id"]: x["vector"] for x in rows}
+
+
+def bootstrap_manifest(client, collection_name):
+    """Build a manifest for a collection that was created before manifests existed. The stored vectors are assumed to match the files on disk."""
+    manifest = {"next_id": 0, "entries": {}}
+    rows = (
+        x
+        for batch in iter_collection(client, collection_name, ["id", "file_name"])
+        for x in batch
+    )
+    for x in rows:
+        path = x["file_name"]
+        if os.path.isfile(path):
+            st = os.stat(path)
+            manifest["entries"][path] = {
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+                "hash": file_hash(path),
+                "id": x["id"],
+            }
+        else:  # keep it so the sync deletes it
+            manifest["entries"][path] = {"size": -1, "mtime": -1, "hash": "", "id": x["id"]}
+        manifest["next_id"] = max(manifest["next_id"], x["id"] + 1)
+    return manifest
+
+
+def assign_ids(paths, manifest):
+    """Primary keys for a list of files. Files already in the manifest keep their key, new files get the next free one."""
+    ids = []
+    for path in paths:
+        entry = manifest["entries"].get(path)
+        if entry is not None:
+            ids.append(entry["id"])
+        else:
+            ids.append(manifest["next_id"])
+            manifest["next_id"] += 1
+    return ids
+
+
+def manifest_entry(path, id, digest=None):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime": st.st_mtime, "hash": digest or file_hash(path), "id": id}
+
+
+def _try_dhash(path):
+    """Perceptual hash of a file, None if it cannot be read. One corrupt image must not abort a sync."""
+    try:
+        return dhash(path)
+    except Exception as e:
+        print(f"Could not hash {path}, it is embedded without duplicate reuse: {e}")
+        return None
+
+
+def _reuse_vectors(get_vectors, source):
+    """Fetch the stored vectors of already indexed images with get_vectors(ids). source maps a position in paths to the id of
+    the indexed image with the same perceptual hash. Returns a dict from position in paths to vector."""
+    if len(source) == 0:
+        return {}
+    vector_of_id = get_vectors(set(source.values()))
+    return {i: vector_of_id[id] for i, id in source.items() if id in vector_of_id}
+
+
+def upsert_files(
+    client,
+    nvclip,
+    paths,
+    manifest,
+    collection_name="collection",
+    reuse_duplicates=False,
+    get_vectors=None,
+    digests=None,
+    chunk_size=2048,
+    manifest_path=None,
+    keep_vectors=True,
+    progress=True,
+):
+    """Embed files and write them to the collection, updating the manifest in place. Files already in the manifest keep their primary key so the upsert replaces the old vector.
+    Files are embedded and upserted chunk_size at a time, which keeps each upsert under the gRPC message limit. With manifest_path the
+    manifest is saved after every chunk, so an interrupted sync does not embed the finished chunks again.
+    With reuse_duplicates, files with the same perceptual hash as an indexed image are not embedded and get a copy of its vector instead.
+    The vector is read with get_vectors(ids), by default from the collection. Files of the batch with the same hash are embedded once.
+    digests maps paths to the file_hash the caller already computed, every other file is hashed once here.
+    progress=False keeps the embedding calls quiet, e.g. on the folder watcher thread.
+    Returns the primary keys and the embeddings (None with keep_vectors=False)."""
+    if len(paths) == 0:
+        return [], None
+    entries = manifest["entries"]
+    ids = assign_ids(paths, manifest)
+    digests = digests or {}
+
+    hashes = [_try_dhash(path) for path in paths] if reuse_duplicates else [None] * len(paths)
+    if get_vectors is None:
+        get_vectors = lambda ids: fetch_vectors(client, ids, collection_name)
+    # hashes indexed before this call. Files of this call are matched with each other below, their rows may not be readable yet
+    id_of_hash = {e["dhash"]: e["id"] for e in entries.values() if "dhash" in e}
+
+    # the first file of each new hash is embedded, the others copy its vector
+    copy_of = {}
+    first_of_hash = {}
+    for i, h in enumerate(hashes):
+        if h is None or h in id_of_hash:
+            continue
+        if h in first_of_hash:
+            copy_of[i] = first_of_hash[h]
+        else:
+            first_of_hash[h] = i
+    shared = set(copy_of.values())
+    shared_vectors = {}  # vectors of the first files that are copied, possibly into later chunks
+
+    all_vectors = np.empty((len(paths), nvclip.dim), dtype=np.float32) if keep_vectors else None
+    reused_count = len(copy_of)
+    for start in range(0, len(paths), chunk_size):
+        chunk = range(start, min(start + chunk_size, len(paths)))
+        chunk_digests = {i: digests.get(paths[i]) or file_hash(paths[i]) for i in chunk}
+        reused = _reuse_vectors(
+            get_vectors, {i: id_of_hash[hashes[i]] for i in chunk if hashes[i] in id_of_hash}
+        )
+        reused_count += len(reused)
+
+        vectors = np.empty((len(chunk), nvclip.dim), dtype=np.float32)
+        embed_idx = [i for i in chunk if i not in reused and i not in copy_of]
+        if len(embed_idx) > 0:
+            vectors[[i - start for i in embed_idx]] = nvclip(
+                [paths[i] for i in embed_idx],
+                return_numpy=True,
+                digests=[chunk_digests[i] for i in embed_idx],
+                progress=progress,
+            )
+        for i in embed_idx:
+            if i in shared:
+                shared_vectors[i] = vectors[i - start]
+        for i, vector in reused.items():
+            vectors[i - start] = vector
+        for i in chunk:
+            if i in copy_of:
+                vectors[i - start] = shared_vectors[copy_of[i]]
+        upsert_rows(client, collection_name, [ids[i] for i in chunk], [paths[i] for i in chunk], vectors)
+
+        for i in chunk:
+            entries[paths[i]] = manifest_entry(paths[i], ids[i], chunk_digests[i])
+            if hashes[i] is not None:
+                entries[paths[i]]["dhash"] = hashes[i]
+        if manifest_path is not None:
+            save_manifest(manifest_path, manifest)
+        if keep_vectors:
+            all_vectors[start : start + len(chunk)] = vectors
+
+    if reused_count > 0:
+        print(f"reused embeddings for {reused_count} duplicate images")
+    return ids, all_vectors
+
+
+def open_manifest(client, manifest_path, collection_name="collection"):
+    """Load the manifest, or rebuild it from the collection if it is missing"""
+    if os.path.exists(manifest_path):
+        return load_manifest(manifest_path)
+    return bootstrap_manifest(client, collection_name)
+
+
+def remove_files(client, paths, manifest, collection_name="collection"):
+    """Delete files from the collection and the manifest"""
+    entries = manifest["entries"]
+    if len(paths) > 0:
+        ids = []
+        for path in paths:  # a video has one row per keyframe
+            ids.extend(entries[path]["ids"] if "ids" in entries[path] else [entries[path]["id"]])
+        client.delete(collection_name=collection_name, ids=ids)
+        for path in paths:
+            del entries[path]
+
+
+def sync_collection(
+    client, nvclip, image_folder, manifest_path, collection_name="collection", reuse_duplicates=False, exclude=()
+):
+    """Bring the collection in line with the image folder. Only new or modified images are embedded and removed images are deleted.
+    Directories in exclude are not searched."""
+    manifest = open_manifest(client, manifest_path, collection_name)
+
+    digests = {}
+    added, changed, removed = diff_folder(image_folder, manifest, exclude, digests)
+    print(f"sync: {len(added)} added, {len(changed)} changed, {len(removed)} removed")
+
+    remove_files(client, removed, manifest, collection_name)
+    upsert_files(
+        client,
+        nvclip,
+        added + changed,
+        manifest,
+        collection_name,
+        reuse_duplicates,
+        digests=digests,
+        manifest_path=manifest_path,
+        keep_vectors=False,
+    )
+
+    save_manifest(manifest_path, manifest)
+    return manifest
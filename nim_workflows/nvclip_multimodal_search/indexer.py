@@ -0,0 +1,289 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from time import time
+
+from pymilvus import MilvusClient
+from tqdm import tqdm
+
+from nvclip import NVCLIP
+from discovery import ImagePath, file_hash
+from index_config import INDEX_TYPES, create_collection
+from index_sync import (
+    manifest_path_for,
+    open_manifest,
+    save_manifest,
+    diff_folder,
+    generated_dirs_for,
+    remove_files,
+    assign_ids,
+    manifest_entry,
+    upsert_rows,
+)
+
+
+def checkpoint_path_for(db_name):
+    """The checkpoint is stored next to the Milvus Lite db file."""
+    return str(Path(db_name).with_suffix(".checkpoint.jsonl"))
+
+
+class Checkpoint:
+
+    def __init__(self, checkpoint_path):
+        """Append only journal of an indexing job. The first line describes the job, followed by one line per planned chunk,
+        a line marking the plan complete and one line per chunk written to the collection."""
+        self.path = checkpoint_path
+        self.header = None
+        self.chunks = {}  # chunk number -> (ids, paths)
+        self.planned = False
+        self.done = {}  # chunk number -> manifest entries of its files
+        self.file = None
+
+    def load(self):
+        """Read an existing journal. A partially written last line from a crash is ignored."""
+        if not os.path.exists(self.path):
+            return self
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if "job" in record:
+                    self.header = record
+                elif "chunk" in record:
+                    self.chunks[record["chunk"]] = (record["ids"], record["paths"])
+                elif "planned" in record:
+                    self.planned = True
+                elif "done" in record:
+                    self.done[record["done"]] = record["entries"]
+        return self
+
+    def matches(self, job):
+        return self.planned and self.header is not None and self.header["job"] == job
+
+    def _append(self, record, sync=False):
+        self.file.write(json.dumps(record) + "\n")
+        if sync:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def start(self, job, chunks):
+        """Write a new plan, replacing any previous journal"""
+        self.header, self.chunks, self.planned, self.done = {"job": job, "created": time()}, {}, False, {}
+        self.file = open(self.path, "w")
+        self._append(self.header)
+        for i, (ids, paths) in enumerate(chunks):
+            self.chunks[i] = (ids, paths)
+            self._append({"chunk": i, "ids": ids, "paths": paths})
+        self._append({"planned": len(self.chunks)}, sync=True)
+        self.planned = True
+
+    def resume(self):
+        self.file = open(self.path, "a")
+
+    def pending(self):
+        return [i for i in sorted(self.chunks) if i not in self.done]
+
+    def mark_done(self, chunk, entries):
+        self.done[chunk] = entries
+        self._append({"done": chunk, "entries": entries}, sync=True)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def plan(client, image_folder, manifest, chunk_size, collection_name, exclude=()):
+    """Diff the folder against the manifest, delete removed files and split new or changed files into chunks with fixed primary keys"""
+    added, changed, removed = diff_folder(image_folder, manifest, exclude)
+    print(f"plan: {len(added)} added, {len(changed)} changed, {len(removed)} removed")
+    remove_files(client, removed, manifest, collection_name)
+
+    paths = added + changed
+    ids = assign_ids(paths, manifest)
+    return [
+        (ids[i : i + chunk_size], [str(x) for x in paths[i : i + chunk_size]])
+        for i in range(0, len(paths), chunk_size)
+    ]
+
+
+def embed_chunk(nvclip, chunk, ids, paths):
+    """Embed the files of one chunk that still exist. Runs on a worker thread."""
+    keep = [i for i, path in enumerate(paths) if os.path.isfile(path)]
+    ids = [ids[i] for i in keep]
+    paths = [ImagePath(paths[i]) for i in keep]
+    digests = [file_hash(path) for path in paths]  # shared by the cache key and the manifest entry
+    vectors = nvclip(paths, workers=1, return_numpy=True, digests=digests, progress=False) if paths else None
+    return chunk, ids, paths, digests, vectors
+
+
+def run(client, nvclip, checkpoint, manifest, manifest_path, collection_name, workers, save_every):
+    """Embed the pending chunks on a pool of threads. Every finished chunk is upserted right away and journaled, so an interrupted
+    job loses at most the chunks in flight. Failed chunks are skipped and retried on the next run. Returns the number of failed chunks."""
+    pending = iter(checkpoint.pending())
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(
+        total=len(checkpoint.chunks), initial=len(checkpoint.done), unit="chunk"
+    ) as progress:
+        in_flight = set()
+        while True:
+            for chunk in pending:  # keep a bounded number of chunks in flight
+                ids, paths = checkpoint.chunks[chunk]
+                in_flight.add(executor.submit(embed_chunk, nvclip, chunk, ids, paths))
+                if len(in_flight) >= 2 * workers:
+                    break
+            if not in_flight:
+                break
+
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    chunk, ids, paths, digests, vectors = future.result()
+                    if len(ids) > 0:
+                        upsert_rows(client, collection_name, ids, paths, vectors)
+                    entries = {
+                        path: manifest_entry(path, id, digest) for id, path, digest in zip(ids, paths, digests)
+                    }
+                except Exception as e:
+                    failed += 1
+                    print(f"Chunk failed, it will be retried on the next run: {e}")
+                    continue
+
+                checkpoint.mark_done(chunk, entries)
+                manifest["entries"].update(entries)
+                progress.update(1)
+                if len(checkpoint.done) % save_every == 0:
+                    save_manifest(manifest_path, manifest)
+
+    save_manifest(manifest_path, manifest)
+    return failed
+
+
+if __name__ == "__main__":
+    """Headless bulk indexing. Embeds an image folder into the search database in checkpointed chunks and can be resumed after a failure."""
+    parser = argparse.ArgumentParser(description="NV-CLIP Bulk Indexer")
+    parser.add_argument("image_folder", type=str, help="Path to folder of images to embed")
+    parser.add_argument("api_key", type=str, help="NVIDIA NIM API Key")
+    parser.add_argument(
+        "--nvclip_url",
+        type=str,
+        default="https://integrate.api.nvidia.com/v1/embeddings",
+        help="URL to NV-CLIP NIM",
+    )
+    parser.add_argument(
+        "--milvus_uri",
+        type=str,
+        default=None,
+        help="Milvus server URI. Defaults to a local Milvus Lite db named after the image folder",
+    )
+    parser.add_argument(
+        "--index_type",
+        type=str,
+        default="FLAT",
+        choices=list(INDEX_TYPES.keys()),
+        help="Vector index type used when the collection is created",
+    )
+    parser.add_argument("--index_params", type=json.loads, default=None, help="JSON index build params")
+    parser.add_argument(
+        "--quantization",
+        type=str,
+        default="none",
+        choices=["none", "int8", "binary"],
+        help="Store binary codes for main.py --quantization when the collection is created",
+    )
+    parser.add_argument("--chunk_size", type=int, default=64, help="Images per checkpoint entry. Chunks larger than 64 are sent as several requests")
+    parser.add_argument("--workers", type=int, default=16, help="Number of chunks embedded concurrently")
+    parser.add_argument(
+        "--preprocess_workers",
+        type=int,
+        default=0,
+        help="Number of processes used to encode images before upload. 0 encodes on the worker threads",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="embedding_cache",
+        help="Folder to cache embeddings in. Pass an empty string to disable",
+    )
+    parser.add_argument(
+        "--save_every",
+        type=int,
+        default=100,
+        help="Save the manifest every N finished chunks",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Ignore an existing checkpoint and plan the job again",
+    )
+    args = parser.parse_args()
+
+    nvclip = NVCLIP(
+        args.api_key,
+        base_url=args.nvclip_url,
+        preprocess_workers=args.preprocess_workers,
+        cache_dir=args.cache_dir or None,
+    )
+
+    db_name = str(Path(args.image_folder).name) + ".db"
+    client = MilvusClient(args.milvus_uri or db_name)
+    manifest_path = manifest_path_for(db_name)
+    checkpoint = Checkpoint(checkpoint_path_for(db_name)).load()
+    if not client.has_collection(collection_name="collection"):
+        create_collection(
+            client,
+            "collection",
+            NVCLIP.dim,
+            index_type=args.index_type,
+            params=args.index_params,
+            scalar_indexes=args.milvus_uri is not None,  # not supported by Milvus Lite
+            binary_codes=args.quantization != "none",
+        )
+        Path(manifest_path).unlink(missing_ok=True)
+        checkpoint = Checkpoint(checkpoint.path)
+
+    manifest = open_manifest(client, manifest_path)
+    job = {"folder": os.path.abspath(args.image_folder), "chunk_size": args.chunk_size}
+    if checkpoint.matches(job) and not args.restart:
+        # chunks journaled as done are already in the collection, they may be missing from the last saved manifest
+        print(f"resuming: {len(checkpoint.done)} of {len(checkpoint.chunks)} chunks already done")
+        for entries in checkpoint.done.values():
+            manifest["entries"].update(entries)
+        for ids, _ in checkpoint.chunks.values():  # keys handed out by the plan must not be reused
+            manifest["next_id"] = max([manifest["next_id"]] + [id + 1 for id in ids])
+        checkpoint.resume()
+    else:
+        chunks = plan(
+            client, args.image_folder, manifest, args.chunk_size, "collection", exclude=generated_dirs_for(db_name)
+        )
+        save_manifest(manifest_path, manifest)  # persist the deletions and reserved keys before any upsert
+        checkpoint.start(job, chunks)
+
+    failed = run(client, nvclip, checkpoint, manifest, manifest_path, "collection", args.workers, args.save_every)
+    checkpoint.close()
+
+    if failed > 0:
+        print(f"{failed} chunks failed. Run the same command again to retry them")
+        sys.exit(1)
+    Path(checkpoint.path).unlink(missing_ok=True)
+    print(f"indexing complete: {len(manifest['entries'])} images in the database")
@@ -14,63 +14,189 @@
 # limitations under the License.
 
 import argparse
+import asyncio
+import base64
+import binascii
+import io
+import json
 import os
+from collections import OrderedDict
 from pathlib import Path
+from threading import Lock
+from urllib.parse import quote
 
 import numpy as np
-from sklearn.manifold import TSNE
 import uvicorn
-from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, Request
 from bokeh.plotting import figure
 from bokeh.models import ColumnDataSource, HoverTool
 import gradio as gr
-from pymilvus import MilvusClient
+from PIL import Image
+from pydantic import BaseModel, Field
+from pymilvus import MilvusClient, MilvusException
 
 from nvclip import NVCLIP
+from index_sync import manifest_path_for, generated_dirs_for, sync_collection, upsert_files, save_manifest
+from folder_watcher import FolderWatcher
+from projection import projection_path_for, project, place_new
+from index_config import (
+    INDEX_TYPES,
+    CODE_FIELD,
+    binary_codes,
+    create_collection,
+    search_params,
+    collection_index_type,
+    has_binary_codes,
+    load_all_fields,
+    load_without_vectors,
+)
+from quantized_index import QuantizedIndex
+from export import export_collection, VectorFile
+from discovery import Text
+from dedup import DuplicateClusters, dedup_path_for
+from video_ingest import keyframe_dir_for, keyframes_by_id, sync_videos
+from thumbnails import ThumbnailStore, CachedStaticFiles
 
 milvus_client_g = None
 nvclip_g = None
 embeddings_2d_g = None
+vectors_g = None  # memory map of vector_file_g.vectors, row i belongs to the i-th id
+vector_file_g = None
 image_paths_g = None
+row_of_id_g = None  # primary key -> row in embeddings_2d_g and image_paths_g
+image_server_url_g = None
+image_folder_g = None
+keyframe_dir_g = None
+keyframes_g = {}  # primary key of a video keyframe -> (video, timestamp)
+manifest_g = None
+manifest_path_g = None
+ingest_lock_g = Lock()
+collection_version_g = 0  # bumped on every ingest so cached search results go stale
+query_tasks_g = {}  # in-flight text query per gradio session, cancelled when a newer query arrives
+text_vectors_g = OrderedDict()  # text query -> embedding, least recently used first
+text_hits_g = OrderedDict()  # (query, filter, collection version) -> hits
+QUERY_CACHE_SIZE = 1024
+QUERY_DEBOUNCE_S = 0.3
+text_session_g = None  # keep-alive aiohttp session for text queries, created on the gradio event loop
+layout_version_g = 0  # bumped when the background t-SNE replaces the PCA layout
+layout_refining_g = False
+LAYOUT_POLL_S = 2.0
+MAX_SCATTER_POINTS = 20_000  # above this the base layer is aggregated into a density grid
+DENSITY_BINS = 200
+search_params_g = None
+top_k_g = 20
+quantized_g = None  # optional int8/binary first pass index, searched instead of milvus
+rerank_factor_g = 10
+binary_codes_g = False  # the collection stores binary codes, filtered quantized searches run on them
+vectors_loaded_g = True  # false once milvus holds only the binary codes, not the float vectors
+file_names_g = None
+thumbnails_g = None
+duplicates_g = None  # near duplicate clusters, collapsed in search results when set
+DUPLICATE_OVERFETCH = 3  # extra hits fetched so a page of collapsed results is still full
+MAX_TOP_K = 1024  # per query limit of the /search endpoint
+reuse_duplicates_g = False
+
+
+def image_url(file_name):
+    """URL of an image on the file server. Images in sub folders keep their relative path."""
+    if keyframe_dir_g is not None and Path(file_name).is_relative_to(keyframe_dir_g):
+        relative = Path(os.path.relpath(file_name, keyframe_dir_g)).as_posix()
+        return f"{image_server_url_g}/keyframes/{quote(relative)}"
+    relative = Path(os.path.relpath(file_name, image_folder_g)).as_posix()
+    return f"{image_server_url_g}/images/{quote(relative)}"
+
+
+def thumbnail_url(file_name):
+    """URL of the small webp preview of an image. Used by the gallery and the plot tooltips."""
+    try:
+        name = thumbnails_g.name_for(file_name)
+    except OSError:  # image was deleted since it was indexed
+        return image_url(file_name)
+    if not (thumbnails_g.folder / name).exists():  # the image could not be thumbnailed
+        return image_url(file_name)
+    return f"{image_server_url_g}/thumbs/{name}"
+
+
+def _density_layer(p, embeddings_2d, bins=DENSITY_BINS):
+    """Aggregate the points into a 2D histogram and draw one rectangle per occupied cell, shaded by log count."""
+    counts, x_edges, y_edges = np.histogram2d(
+        embeddings_2d[:, 0], embeddings_2d[:, 1], bins=bins
+    )
+    xi, yi = np.nonzero(counts)
+    alpha = np.log1p(counts[xi, yi])
+    source = ColumnDataSource(
+        dict(
+            x=(x_edges[xi] + x_edges[xi + 1]) / 2,
+            y=(y_edges[yi] + y_edges[yi + 1]) / 2,
+            alpha=0.15 + 0.85 * alpha / alpha.max(),
+        )
+    )
+    return p.rect(
+        "x",
+        "y",
+        width=x_edges[1] - x_edges[0],
+        height=y_edges[1] - y_edges[0],
+        source=source,
+        fill_alpha="alpha",
+        line_alpha=0,
+        legend_label="Image Density",
+    )
 
 
-def highlighted_plot(vector_ids=None):
-    """Plot 2D embeddings and highlight specific vector_ids in red."""
+def plot_version():
+    """Changes whenever the points of the plot change, i.e. when images are ingested or the t-SNE layout replaces the PCA layout"""
+    return (collection_version_g, layout_version_g)
 
-    global embeddings_2d_g
-    global image_paths_g
 
-    if vector_ids is None:
-        vector_ids = []
+def highlight_data(vector_ids):
+    """Coordinates and thumbnails of the highlighted points. This is all that is sent to the browser per query."""
+    rows = [row_of_id_g[i] for i in vector_ids if i in row_of_id_g]
+    return dict(
+        x=embeddings_2d_g[rows, 0].tolist(),
+        y=embeddings_2d_g[rows, 1].tolist(),
+        image_path=[image_paths_g[i] for i in rows],
+    )
+
+
+# runs in the browser after each query. Swaps the data of the highlight layer of the plot that is already on the page
+HIGHLIGHT_JS = """
+(highlights) => {
+    if (window.Bokeh && highlights) {
+        for (const doc of window.Bokeh.documents) {
+            const source = doc.get_model_by_name("highlight");
+            if (source) {
+                source.data = highlights;
+            }
+        }
+    }
+    return [];
+}
+"""
+
+
+def build_plot(vector_ids=()):
+    """Plot 2D embeddings and highlight specific vector_ids in red. A new figure is built for every session, it is only sent when
+    the session loads or the points changed. Queries update the named highlight source in the browser instead."""
 
-    # Create plot
     p = figure(
         title="NV-CLIP Embedding Visualization",
-        tools="pan,wheel_zoom,box_zoom,reset,hover,save",
-        tooltips="""
-            <div>
-                <div>
-                    <img src="@image_path" height="100" alt="file_name" style="float: left; margin: 0px 15px 15px 0px;"/>
-                </div>
-            </div>
-        """,
+        tools="pan,wheel_zoom,box_zoom,reset,save",
     )
 
-    highlight_embeddings = embeddings_2d_g[vector_ids]
-    highlight_image_paths = [image_paths_g[i] for i in vector_ids]
-    source = ColumnDataSource(
-        dict(x=embeddings_2d_g[:, 0], y=embeddings_2d_g[:, 1], image_path=image_paths_g)
-    )
-    highlight_source = ColumnDataSource(
-        dict(
-            x=highlight_embeddings[:, 0],
-            y=highlight_embeddings[:, 1],
-            image_path=highlight_image_paths,
+    # large corpora are drawn as a density grid so the plot stays small. Image previews are then only shown for the highlighted points
+    hover_renderers = []
+    if len(embeddings_2d_g) <= MAX_SCATTER_POINTS:
+        source = ColumnDataSource(
+            dict(x=embeddings_2d_g[:, 0], y=embeddings_2d_g[:, 1], image_path=image_paths_g)
         )
-    )
-    p.scatter("x", "y", source=source, size=8, legend_label="Image Embedding")
-    if vector_ids != 0:
+        hover_renderers.append(
+            p.scatter("x", "y", source=source, size=8, legend_label="Image Embedding")
+        )
+    else:
+        _density_layer(p, embeddings_2d_g)
+
+    highlight_source = ColumnDataSource(highlight_data(vector_ids), name="highlight")
+    hover_renderers.append(
         p.scatter(
             "x",
             "y",
@@ -79,43 +205,374 @@ def highlighted_plot(vector_ids=None):
             color="red",
             legend_label="Similar Images",
         )
+    )
+    p.add_tools(
+        HoverTool(
+            renderers=hover_renderers,
+            tooltips="""
+            <div>
+                <div>
+                    <img src="@image_path" height="100" alt="file_name" style="float: left; margin: 0px 15px 15px 0px;"/>
+                </div>
+            </div>
+        """,
+        )
+    )
     return p
 
 
-def query_callback(query):
-    """Callback for text and image search. Returns closest images based on vector similarity and updated plot."""
-    global milvus_client_g
-    global nvclip_g
-    global image_paths_g
+def load_plot():
+    """Send the plot once when a session loads"""
+    return build_plot(), plot_version()
 
-    if query == "":
-        return [], highlighted_plot()
 
-    resp = nvclip_g([query])
-    query_vector = resp["data"][0]["embedding"]
+def apply_refined_layout(ids, coords):
+    """Called from the background t-SNE thread. Replaces the PCA layout; images ingested since t-SNE started are placed next to their neighbours.
+    coords is None if t-SNE failed, the PCA layout is kept and the sessions stop polling."""
+    global embeddings_2d_g
+    global layout_version_g
+    global layout_refining_g
+
+    if coords is None:
+        layout_refining_g = False
+        return
+
+    with ingest_lock_g:
+        new_embeddings_2d = np.empty_like(embeddings_2d_g)
+        refined_rows = np.array([row_of_id_g[id] for id in ids], dtype=np.int64)
+        new_embeddings_2d[refined_rows] = coords
+        is_new = np.ones(len(new_embeddings_2d), dtype=bool)
+        is_new[refined_rows] = False
+        if is_new.any():
+            new_embeddings_2d[is_new] = place_new(
+                vectors_g[is_new], vectors_g[refined_rows], coords
+            )
+        embeddings_2d_g = new_embeddings_2d
+        layout_version_g += 1
+        layout_refining_g = False
+    print("t-SNE layout ready")
+
+
+def refresh_layout(seen_version, highlight_ids):
+    """Polled by each UI session while t-SNE runs. Sends the refined plot once, with the session's own highlights, then stops the timer."""
+    timer = gr.Timer(active=layout_refining_g)
+    version = plot_version()
+    if seen_version == version:
+        return gr.update(), seen_version, timer
+    return build_plot(highlight_ids or []), version, timer
+
+
+def search_vectors(query_vectors, limit=None, filter=""):
+    """Search the collection. Returns a list of (file_name, id, score) hits per query vector. Near duplicates are collapsed if enabled.
+    filter is a Milvus boolean expression over the metadata fields, e.g. 'camera like "Canon%" and capture_time > 1717200000'."""
+    limit = limit or top_k_g
+    if duplicates_g is not None:
+        hits = _search_vectors(query_vectors, limit * DUPLICATE_OVERFETCH, filter)
+        return [duplicates_g.collapse(x, limit) for x in hits]
+    return _search_vectors(query_vectors, limit, filter)
+
+
+def _search_vectors(query_vectors, limit, filter=""):
+    results = None
+    if quantized_g is not None and not filter:
+        results = quantized_g.search(
+            query_vectors, k=limit, rerank=limit * rerank_factor_g
+        )
+    elif quantized_g is not None and binary_codes_g:
+        # the quantized index only holds vectors. Filters are applied by milvus on the binary codes and the candidates re-ranked exactly
+        candidates = milvus_client_g.search(
+            collection_name="collection",
+            data=binary_codes(query_vectors),
+            anns_field=CODE_FIELD,
+            limit=limit * rerank_factor_g,
+            output_fields=["id"],
+            search_params={"metric_type": "HAMMING"},
+            filter=filter,
+        )
+        results = quantized_g.rerank(
+            query_vectors, [[x["entity"]["id"] for x in hits] for hits in candidates], k=limit
+        )
+    if results is not None:
+        return [
+            [(file_names_g[row_of_id_g[id]], id, score) for id, score in hits]
+            for hits in results
+        ]
+
     results = milvus_client_g.search(
         collection_name="collection",
-        data=[query_vector],
-        limit=20,
+        data=query_vectors.tolist(),
+        anns_field="vector",
+        limit=limit,
         output_fields=["file_name", "id"],
+        search_params=search_params_g,
+        filter=filter,
     )
-    image_paths = [x["entity"]["file_name"] for x in results[0]]
-    vector_ids = [x["entity"]["id"] for x in results[0]]
+    return [
+        [(x["entity"]["file_name"], x["entity"]["id"], x["distance"]) for x in hits]
+        for hits in results
+    ]
 
-    image_paths = [image_paths_g[i] for i in vector_ids]
 
-    return image_paths, highlighted_plot(vector_ids)
+def _cache_get(cache, key):
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
 
 
-def main(image_folder, gradio_port):
-    """Create file server and launch Gradio UI"""
+def _cache_put(cache, key, value):
+    cache[key] = value
+    if len(cache) > QUERY_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+async def embed_text(query):
+    """Text embeddings only depend on the query string. Cancelling the caller aborts the request."""
+    global text_session_g
+
+    vectors = _cache_get(text_vectors_g, query)
+    if vectors is None:
+        if text_session_g is None:
+            text_session_g = nvclip_g._make_session(concurrency=16)
+        response = await nvclip_g.embed_async([Text(query)], session=text_session_g)
+        vectors = np.asarray([x["embedding"] for x in response["data"]], dtype=np.float32)
+        _cache_put(text_vectors_g, query, vectors)
+    return vectors
 
+
+async def search_text(query, filter):
+    """Top-k hits for a text query after typing pauses. Results are keyed on the collection version so new images invalidate old results."""
+    await asyncio.sleep(QUERY_DEBOUNCE_S)  # a newer keystroke cancels the query while it waits here
+    key = (query, filter, collection_version_g)
+    hits = _cache_get(text_hits_g, key)
+    if hits is None:
+        vectors = await embed_text(query)
+        hits = (await asyncio.to_thread(_ui_search, search_vectors, vectors, None, filter))[0]
+        _cache_put(text_hits_g, key, hits)
+    return hits
+
+
+def _ui_search(search, *args):
+    """Run a search for the UI. Invalid filter expressions are shown to the user."""
+    try:
+        return search(*args)
+    except MilvusException as e:
+        raise gr.Error(f"Search failed, check the filter expression: {e}")
+
+
+def caption(id):
+    if id not in keyframes_g:
+        return None
+    video, t = keyframes_g[id]
+    return f"{Path(video).name} @ {int(t) // 60}:{int(t) % 60:02d}"
+
+
+def search_results(hits, seen_version):
+    """Gallery images, plot update, highlighted points, highlighted ids and plot version for a list of (file_name, id, score) hits.
+    The plot is only sent again if its points changed since the session last received it. Video keyframes are captioned with their timestamp."""
+    image_paths = [(thumbnail_url(file_name), caption(id)) for file_name, id, _ in hits]
+    vector_ids = [id for _, id, _ in hits]
+    version = plot_version()
+    plot = gr.update() if seen_version == version else build_plot(vector_ids)
+    return image_paths, plot, highlight_data(vector_ids), vector_ids, version
+
+
+def query_callback(query, filter, seen_version):
+    """Callback for image search. Returns closest images based on vector similarity and the points to highlight."""
+
+    if query is None or query == "":
+        return search_results([], seen_version)
+
+    query_vectors = nvclip_g([query], return_numpy=True, progress=False)
+    hits = _ui_search(search_vectors, query_vectors, None, filter.strip())[0]
+    return search_results(hits, seen_version)
+
+
+async def text_query_callback(query, filter, seen_version, request: gr.Request):
+    """Callback for text search, fired on every keystroke. Each keystroke cancels the query still in flight for the same session,
+    whether it is waiting for typing to pause or embedding, so only the last query of a burst is embedded and searched."""
+    session = request.session_hash
+    previous = query_tasks_g.pop(session, None)
+    if previous is not None:
+        previous.cancel()
+    if query == "":
+        return search_results([], seen_version)
+
+    task = asyncio.ensure_future(search_text(query, filter.strip()))
+    query_tasks_g[session] = task
+    try:
+        hits = await task
+    except asyncio.CancelledError:
+        if query_tasks_g.get(session) is task:  # cancelled by gradio, not by a newer query
+            raise
+        return gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
+    finally:
+        if query_tasks_g.get(session) is task:
+            del query_tasks_g[session]
+    return search_results(hits, seen_version)
+
+
+class SearchRequest(BaseModel):
+    """Batch of search queries. Images are base64 encoded image files, optionally as data URLs."""
+
+    text: list[str] = []
+    images: list[str] = []
+    top_k: int = Field(20, ge=1, le=MAX_TOP_K)
+    filter: str = ""  # Milvus boolean expression over the metadata fields
+
+
+def _decode_image(image_b64):
+    if image_b64.startswith("data:"):
+        image_b64 = image_b64.split(",", 1)[-1]
+    try:
+        image = Image.open(io.BytesIO(base64.b64decode(image_b64)))
+        image.load()  # decode here so truncated images are rejected as bad requests too
+    except (binascii.Error, OSError, Image.DecompressionBombError):
+        raise HTTPException(status_code=400, detail="Could not decode image query")
+    return image
+
+
+def search_endpoint(request: SearchRequest):
+    """Embed all queries in one NVCLIP call and run one multi-vector search. Results are returned in query order, text queries first."""
+    queries = [Text(x) for x in request.text] + [_decode_image(x) for x in request.images]
+    if len(queries) == 0:
+        return {"results": []}
+
+    query_vectors = nvclip_g(queries, return_numpy=True, progress=False)
+    try:
+        hits = search_vectors(query_vectors, limit=request.top_k, filter=request.filter)
+    except MilvusException as e:
+        raise HTTPException(status_code=400, detail=f"Invalid filter: {e}")
+
+    query_types = ["text"] * len(request.text) + ["image"] * len(request.images)
+    query_indices = list(range(len(request.text))) + list(range(len(request.images)))
+    return {
+        "results": [
+            {
+                "type": query_type,
+                "index": query_index,
+                "hits": [
+                    {
+                        "id": id,
+                        "file_name": file_name,
+                        "url": image_url(file_name),
+                        "thumbnail_url": thumbnail_url(file_name),
+                        "score": score,
+                        **(
+                            {"video": keyframes_g[id][0], "timestamp": keyframes_g[id][1]}
+                            if id in keyframes_g
+                            else {}
+                        ),
+                    }
+                    for file_name, id, score in query_hits
+                ],
+            }
+            for query_type, query_index, query_hits in zip(query_types, query_indices, hits)
+        ]
+    }
+
+
+def thumbnail_endpoint(name: str, request: Request):
+    return thumbnails_g.serve(name, request)
+
+
+def ingest_batch(paths):
+    """Called by the folder watcher with a micro batch of new images. They are searchable as soon as the upsert returns."""
+    global embeddings_2d_g
+    global vectors_g
     global image_paths_g
+    global row_of_id_g
+    global file_names_g
+    global collection_version_g
+
+    with ingest_lock_g:
+        paths = [x for x in paths if Path(x).is_file() and not _indexed(x)]
+        thumbnails_g.build(paths)
+        ids, vectors = upsert_files(
+            milvus_client_g,
+            nvclip_g,
+            paths,
+            manifest_g,
+            reuse_duplicates=reuse_duplicates_g,
+            get_vectors=None if vectors_loaded_g else stored_vectors,
+            progress=False,
+        )
+        save_manifest(manifest_path_g, manifest_g)
+        if len(ids) == 0:
+            return
+
+        # place the new images in the existing plot layout next to their nearest neighbours
+        coords = place_new(vectors, vectors_g, embeddings_2d_g)
+        is_new = np.array([id not in row_of_id_g for id in ids], dtype=bool)
+        new_embeddings_2d = np.vstack([embeddings_2d_g, coords[is_new]])
+        # the vectors stay on disk. Modified rows are overwritten and new rows appended in the order of their new row numbers
+        vector_file_g.update([row_of_id_g[id] for id in np.asarray(ids)[~is_new].tolist()], vectors[~is_new])
+        vector_file_g.append(vectors[is_new])
+        new_vectors = vector_file_g.vectors
+        new_image_paths = list(image_paths_g)
+        new_file_names = list(file_names_g)
+        new_row_of_id = dict(row_of_id_g)
+        for id, path, coord in zip(ids, paths, coords):
+            row = new_row_of_id.get(id)
+            if row is None:  # new image
+                new_row_of_id[id] = len(new_image_paths)
+                new_image_paths.append(thumbnail_url(path))
+                new_file_names.append(path)
+            else:  # modified image
+                new_embeddings_2d[row] = coord
+                new_image_paths[row] = thumbnail_url(path)  # thumbnail name changes with the file
+
+        collection_version_g += 1
+
+        # swap in the new state in one go so queries never see a partial update
+        embeddings_2d_g, vectors_g, image_paths_g, file_names_g, row_of_id_g = (
+            new_embeddings_2d,
+            new_vectors,
+            new_image_paths,
+            new_file_names,
+            new_row_of_id,
+        )
+        if quantized_g is not None:
+            quantized_g.add(ids, vectors)
+        if duplicates_g is not None:
+            all_ids = [None] * len(new_row_of_id)
+            for id, row in new_row_of_id.items():
+                all_ids[row] = id
+            duplicates_g.update(
+                all_ids,
+                new_vectors,
+                rows=[new_row_of_id[id] for id in ids],
+                client=milvus_client_g if vectors_loaded_g else None,
+                search_params=search_params_g,
+            )
+    print(f"ingested {len(ids)} new images")
+
+
+def _indexed(path):
+    """True if the file is in the manifest unchanged, e.g. it was picked up by the startup sync and by the watcher"""
+    entry = manifest_g["entries"].get(path)
+    if entry is None:
+        return False
+    st = os.stat(path)
+    return entry["size"] == st.st_size and entry["mtime"] == st.st_mtime
+
+
+def stored_vectors(ids):
+    """Vectors of indexed images read from the memory map, used when milvus does not hold the float vectors"""
+    return {id: vectors_g[row_of_id_g[id]] for id in ids if id in row_of_id_g}
+
+
+def main(image_folder, gradio_port):
+    """Create file server and launch Gradio UI"""
 
     # create file server for gradio ui. Allows images to be displayed quickly.
     print("creating file server")
     app = FastAPI()
-    app.mount("/images", StaticFiles(directory=image_folder), name="images")
+    app.mount("/images", CachedStaticFiles(directory=image_folder), name="images")
+    app.get("/thumbs/{name}")(thumbnail_endpoint)
+    if keyframe_dir_g is not None:
+        app.mount("/keyframes", CachedStaticFiles(directory=keyframe_dir_g), name="keyframes")
+    app.post("/search")(search_endpoint)
 
     # create gradio UI
     print("creating gradio ui")
@@ -128,27 +585,67 @@ def main(image_folder, gradio_port):
         with gr.Row():
             text_query = gr.Textbox(placeholder="Search Query", show_label=False)
             image_upload = gr.Image(type="filepath")
+        filter_query = gr.Textbox(
+            placeholder='Optional filter, e.g. camera like "Canon%" and capture_time > 1717200000 and folder == "images/dock3"',
+            show_label=False,
+        )
 
         gr.HTML(
             '<h2">The most similar images to the search query will populate the gallery and be highlighted in the embedding plot.</h1>'
         )
         with gr.Row():
             gallery = gr.Gallery(
-                value=[image_paths_g[i] for i in range(20)],
+                value=image_paths_g[:top_k_g],
                 columns=4,
                 height="750px",
                 object_fit="scale-down",
                 preview=False,
             )
-            embedding_plot = gr.Plot(value=highlighted_plot())
-
-        text_query.change(
-            query_callback, text_query, [gallery, embedding_plot], show_progress=False
-        )
-        image_upload.upload(
-            query_callback, image_upload, [gallery, embedding_plot], show_progress=False
+            embedding_plot = gr.Plot()
+        # the plot is sent when the session loads. Queries only send the highlighted points, which are drawn client side
+        highlights = gr.JSON(visible=False)
+        plot_version_state = gr.State(None)
+        highlight_ids = gr.State([])  # highlights of this session, kept when the t-SNE layout replaces the plot
+        blocks.load(load_plot, None, [embedding_plot, plot_version_state])
+
+        # the first layout may be a quick PCA projection. Poll for the t-SNE layout that replaces it
+        layout_timer = gr.Timer(LAYOUT_POLL_S, active=layout_refining_g)
+        layout_timer.tick(
+            refresh_layout,
+            [plot_version_state, highlight_ids],
+            [embedding_plot, plot_version_state, layout_timer],
+            show_progress=False,
         )
 
+        search_outputs = [gallery, embedding_plot, highlights, highlight_ids, plot_version_state]
+        # queries run concurrently so a new keystroke can cancel the one in flight. Waiting queries do not hold a worker thread
+        search_events = [
+            text_query.change(
+                text_query_callback,
+                [text_query, filter_query, plot_version_state],
+                search_outputs,
+                show_progress=False,
+                trigger_mode="multiple",
+                concurrency_limit=None,
+            ),
+            image_upload.upload(
+                query_callback,
+                [image_upload, filter_query, plot_version_state],
+                search_outputs,
+                show_progress=False,
+            ),
+            filter_query.submit(
+                text_query_callback,
+                [text_query, filter_query, plot_version_state],
+                search_outputs,
+                show_progress=False,
+                trigger_mode="multiple",
+                concurrency_limit=None,
+            ),
+        ]
+        for event in search_events:
+            event.then(None, highlights, None, js=HIGHLIGHT_JS)
+
     # mount gradio UI to fastapi server
     app = gr.mount_gradio_app(app, blocks, path="/")
 
@@ -163,7 +660,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "image_folder",
         type=str,
-        help="Path to folder of images to embed and search over",
+        help="Path to folder of images to embed and search over. Sub folders are included",
     )
     parser.add_argument("api_key", type=str, help="NVIDIA NIM API Key")
     parser.add_argument(
@@ -175,66 +672,246 @@ if __name__ == "__main__":
     parser.add_argument(
         "--gradio_port", type=int, default=7860, help="Port to run Gradio UI"
     )
+    parser.add_argument(
+        "--preprocess_workers",
+        type=int,
+        default=0,
+        help="Number of processes used to encode images before upload. 0 encodes on the main thread",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="embedding_cache",
+        help="Folder to cache embeddings in so unchanged images are not re-embedded. Pass an empty string to disable",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep watching the image folder and add new images to the database while the UI is running",
+    )
+    parser.add_argument(
+        "--milvus_uri",
+        type=str,
+        default=None,
+        help="Milvus server URI. Defaults to a local Milvus Lite db named after the image folder",
+    )
+    parser.add_argument(
+        "--index_type",
+        type=str,
+        default="FLAT",
+        choices=list(INDEX_TYPES.keys()),
+        help="Vector index type used when the collection is created. Milvus Lite only supports FLAT",
+    )
+    parser.add_argument(
+        "--index_params",
+        type=json.loads,
+        default=None,
+        help='JSON index build params, e.g. \'{"M": 32, "efConstruction": 256}\'',
+    )
+    parser.add_argument(
+        "--search_params",
+        type=json.loads,
+        default=None,
+        help='JSON search params for the index type of the collection, e.g. \'{"ef": 128}\'',
+    )
+    parser.add_argument(
+        "--top_k", type=int, default=20, help="Number of images returned per search"
+    )
+    parser.add_argument(
+        "--quantization",
+        type=str,
+        default="none",
+        choices=["none", "int8", "binary"],
+        help="Search int8 or binary quantized vectors in memory and re-rank the candidates with exact vectors from a memory mapped file",
+    )
+    parser.add_argument(
+        "--rerank_factor",
+        type=int,
+        default=10,
+        help="With --quantization, top_k * rerank_factor candidates are re-ranked exactly",
+    )
+    parser.add_argument(
+        "--thumbnail_size",
+        type=int,
+        default=256,
+        help="Longest side in pixels of the thumbnails shown in the gallery and plot",
+    )
+    parser.add_argument(
+        "--dedup_threshold",
+        type=float,
+        default=None,
+        help="Group images whose embeddings have a cosine similarity above this (e.g. 0.95) and only show the best match of each group in search results",
+    )
+    parser.add_argument(
+        "--reuse_duplicates",
+        action="store_true",
+        help="Do not embed images with the same perceptual hash as an indexed image, copy its embedding instead",
+    )
+    parser.add_argument(
+        "--videos",
+        action="store_true",
+        help="Also index the videos in the folder. Keyframes are picked at scene changes and searched like images",
+    )
+    parser.add_argument(
+        "--video_sample_fps",
+        type=float,
+        default=2.0,
+        help="Frames per second of video compared for scene changes",
+    )
     args = parser.parse_args()
 
     # connect to NVCLIP NIM
-    nvclip_g = NVCLIP(args.api_key)
+    nvclip_g = NVCLIP(
+        args.api_key,
+        base_url=args.nvclip_url,
+        preprocess_workers=args.preprocess_workers,
+        cache_dir=args.cache_dir or None,
+    )
 
     # Setup Database
     print("creating database client")
     db_name = str(Path(args.image_folder).name) + ".db"
-    milvus_client_g = MilvusClient(db_name)
+    milvus_client_g = MilvusClient(args.milvus_uri or db_name)
+    top_k_g = args.top_k
 
     # try to create database collection. If collection already exists it will use the previously saved embeddings.
     print("creating database collection")
+    manifest_path = manifest_path_for(db_name)
     if not milvus_client_g.has_collection(collection_name="collection"):
         # create collection in database. This will associate a vector with image path
-        milvus_client_g.create_collection(
-            collection_name="collection", dimension=1024  # NVCLIP output dimension
+        create_collection(
+            milvus_client_g,
+            "collection",
+            NVCLIP.dim,
+            index_type=args.index_type,
+            params=args.index_params,
+            scalar_indexes=args.milvus_uri is not None,  # not supported by Milvus Lite
+            binary_codes=args.quantization != "none",
         )
-
-        # embed images
-        print("embedding images")
-        image_names = os.listdir(args.image_folder)
-        image_paths_g = [str(Path(args.image_folder) / x) for x in image_names]
-        resp = nvclip_g(image_paths_g)
-
-        # parse results
-        print("parsing embedding results")
-        image_embedding_data = []
-        for i, data in enumerate(resp["data"]):
-            data = {"id": i, "vector": data["embedding"], "file_name": image_paths_g[i]}
-            image_embedding_data.append(data)
-
-        # insert embeddings
-        res = milvus_client_g.insert(
-            collection_name="collection", data=image_embedding_data
+        # stale manifest, plot layout and duplicate clusters from a deleted db
+        Path(manifest_path).unlink(missing_ok=True)
+        Path(projection_path_for(db_name)).unlink(missing_ok=True)
+        Path(dedup_path_for(db_name)).unlink(missing_ok=True)
+
+    # search params must match the index the collection was built with, not the --index_type of this run
+    index_type = collection_index_type(milvus_client_g, "collection")
+    if index_type != args.index_type:
+        print(f"collection already has a {index_type} index, --index_type {args.index_type} is ignored")
+    search_params_g = search_params(index_type, args.search_params)
+    binary_codes_g = has_binary_codes(milvus_client_g, "collection")
+    if binary_codes_g:  # a previous run with --quantization may have left the float vectors unloaded
+        load_all_fields(milvus_client_g, "collection")
+
+    # watch from before the sync so images added while the app starts up are not missed. They are ingested once it is ready.
+    watcher = None
+    if args.watch:
+        print("watching image folder for new images")
+        watcher = FolderWatcher(
+            args.image_folder, ingest_batch, batch_size=64, exclude=generated_dirs_for(db_name)
         )
-        print("database setup complete")
+        watcher.start(paused=True)
+
+    # embed new and changed images and drop removed ones. Unchanged images keep their stored embeddings.
+    print("syncing database with image folder")
+    manifest_path_g = manifest_path
+    reuse_duplicates_g = args.reuse_duplicates
+    manifest_g = sync_collection(
+        milvus_client_g,
+        nvclip_g,
+        args.image_folder,
+        manifest_path,
+        reuse_duplicates=reuse_duplicates_g,
+        exclude=generated_dirs_for(db_name),  # keyframes and thumbnails are not indexed as images
+    )
+    if args.videos:
+        # only keyframes at scene changes are embedded, so cost scales with visual change rather than duration
+        print("syncing database with videos")
+        keyframe_dir_g = keyframe_dir_for(db_name)
+        Path(keyframe_dir_g).mkdir(exist_ok=True)
+        sync_videos(
+            milvus_client_g,
+            nvclip_g,
+            args.image_folder,
+            manifest_g,
+            keyframe_dir_g,
+            sample_fps=args.video_sample_fps,
+        )
+        save_manifest(manifest_path_g, manifest_g)
+        keyframes_g = keyframes_by_id(manifest_g)
+    print("database setup complete")
 
     # Project vector db embeddings to 2D for plotting
     print("generating 2D projection")
-    res = milvus_client_g.query(
-        collection_name="collection",
-        output_fields=["vector", "file_name"],
-        limit=len(os.listdir(args.image_folder)),
+    # stream the vectors out of the db into a memory map instead of one giant query
+    export_prefix = str(Path(db_name).with_suffix(".export"))
+    _, meta = export_collection(
+        milvus_client_g,
+        "collection",
+        export_prefix,
+        NVCLIP.dim,
+        metadata_fields=["file_name"],
     )
-    vectors = np.array([x["vector"] for x in res])
-    file_names = [x["file_name"] for x in res]
-    image_paths_g = [
-        f"http://localhost:{args.gradio_port}/images/{Path(x).name}" for x in file_names
-    ]
-    # use TSNE to project embeddings to 2D
-    tsne = TSNE(
-        n_components=2,
-        perplexity=20,
-        learning_rate=200,
-        early_exaggeration=30,
-        max_iter=2000,
-        random_state=42,
-        metric="cosine",
-    )
-    embeddings_2d_g = tsne.fit_transform(vectors)
+    # the export is the only copy of the vectors the process keeps, images ingested later are appended to it
+    vector_file_g = VectorFile(export_prefix + ".vectors.f32", NVCLIP.dim)
+    vectors = vector_file_g.vectors
+    ids = meta.column("id").to_pylist()
+    row_of_id_g = {id: i for i, id in enumerate(ids)}
+    image_server_url_g = f"http://localhost:{args.gradio_port}"
+    image_folder_g = args.image_folder
+    file_names_g = meta.column("file_name").to_pylist()
+
+    # small previews for the gallery and plot so result pages do not download full resolution images
+    print("creating thumbnails")
+    thumbnails_g = ThumbnailStore(
+        Path(db_name).with_suffix(".thumbnails"),
+        size=args.thumbnail_size,
+        workers=args.preprocess_workers or None,
+    )
+    thumbnails_g.build(file_names_g)
+    thumbnails_g.prune(file_names_g)
+    image_paths_g = [thumbnail_url(x) for x in file_names_g]
+    # project embeddings to 2D, reusing the saved layout if the vectors have not changed
+    # a new corpus starts with a PCA layout and is refined by t-SNE in the background.
+    # holding the lock keeps the refined layout from being applied before the globals are set
+    with ingest_lock_g:
+        embeddings_2d_g, refine_thread = project(
+            ids, vectors, projection_path_for(db_name), on_refined=apply_refined_layout
+        )
+        vectors_g = vectors
+        layout_refining_g = refine_thread is not None
+
+    if args.quantization != "none":
+        print(f"loading {args.quantization} quantized index")
+        rerank_factor_g = args.rerank_factor
+        quantized_g = QuantizedIndex.load_or_build(
+            str(Path(db_name).with_suffix(f".{args.quantization}.npz")),
+            vector_file_g,
+            ids,
+            mode=args.quantization,
+        )
+        print(f"quantized index uses {quantized_g.memory_bytes() / 1e6:.1f} MB")
+
+    if args.dedup_threshold is not None:
+        duplicates_g = DuplicateClusters.load_or_build(
+            dedup_path_for(db_name),
+            ids,
+            vectors,
+            threshold=args.dedup_threshold,
+            client=milvus_client_g,
+            search_params=search_params_g,
+        )
+
+    if quantized_g is not None:
+        # searches no longer need the float vectors in milvus. The export above and the duplicate search are done with them
+        if binary_codes_g:
+            vectors_loaded_g = not load_without_vectors(milvus_client_g, "collection")
+        else:
+            print("the collection has no binary codes, filtered searches use the float vectors loaded in milvus. Recreate it with --quantization to unload them")
+
+    # keep ingesting images added to the folder while the UI is running
+    if watcher is not None:
+        watcher.resume()
+
     print("launching gradio UI")
 
     # Start Gradio UI
@@ -0,0 +1,64 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import calendar
+from datetime import datetime
+from pathlib import Path
+
+from PIL import Image
+
+# EXIF tags
+MAKE = 271
+MODEL = 272
+DATETIME = 306
+EXIF_IFD = 0x8769
+DATETIME_ORIGINAL = 36867
+
+
+def _exif_time(value):
+    """EXIF 'YYYY:MM:DD HH:MM:SS' as unix seconds. EXIF times carry no time zone so they are read as UTC."""
+    try:
+        return calendar.timegm(datetime.strptime(str(value).strip("\x00 "), "%Y:%m:%d %H:%M:%S").timetuple())
+    except ValueError:
+        return None
+
+
+def extract_metadata(path):
+    """Cheap scalar metadata of an image file: capture time (EXIF, else mtime), camera make and model, parent folder,
+    dimensions and file size. Only the image header is read."""
+    st = os.stat(path)
+    metadata = {
+        "capture_time": int(st.st_mtime),
+        "camera": "",
+        "folder": Path(path).parent.as_posix(),
+        "width": 0,
+        "height": 0,
+        "file_size": st.st_size,
+    }
+    try:
+        with Image.open(path) as image:
+            metadata["width"], metadata["height"] = image.size
+            exif = image.getexif()
+    except OSError as e:
+        print(f"Could not read metadata of {path}: {e}")
+        return metadata
+
+    capture_time = _exif_time(exif.get_ifd(EXIF_IFD).get(DATETIME_ORIGINAL, "")) or _exif_time(exif.get(DATETIME, ""))
+    if capture_time is not None:
+        metadata["capture_time"] = capture_time
+    camera = f"{exif.get(MAKE, '')} {exif.get(MODEL, '')}".replace("\x00", "").strip()
+    metadata["camera"] = camera[:256]
+    return metadata
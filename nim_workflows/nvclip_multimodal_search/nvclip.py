@@ -13,47 +13,42 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import io 
 import requests, base64
-import os 
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from time import time 
 
+import aiohttp
 import numpy as np 
-import cv2
 from PIL import Image 
 from tqdm import tqdm 
 
+from preprocess import encode_image, ImagePreprocessor
+from embedding_cache import EmbeddingCache
+from discovery import is_file_item
+from concurrency import AdaptiveConcurrency, request_with_retry, request_with_retry_async
+
 class NVCLIP:
 
-    def __init__(self, api_key, base_url="https://integrate.api.nvidia.com/v1/embeddings"):
-        """Initialize with NVCLIP url and API key"""
+    model = "nvidia/nvclip"
+    dim = 1024
+
+    def __init__(self, api_key, base_url="https://integrate.api.nvidia.com/v1/embeddings", preprocess_workers=0, cache_dir=None, encoding_format="float", controller=None):
+        """Initialize with NVCLIP url and API key. Set preprocess_workers to encode images on a process pool (None uses all CPUs, 0 encodes on the calling thread).
+        If cache_dir is given, embeddings are cached on disk by content and reused instead of sending a request.
+        encoding_format="base64" asks the endpoint for packed float32 embeddings when return_numpy is used. Only set it for endpoints that support it.
+        controller is the AdaptiveConcurrency limit of the embedding endpoint, a new one is created if not given."""
         self.base_url = base_url
         self.api_key = api_key
         self.headers = {"Authorization": f"Bearer {self.api_key}", "Accept": "application/json"}
+        self.preprocessor = None if preprocess_workers == 0 else ImagePreprocessor(workers=preprocess_workers)
+        self.cache = None if cache_dir is None else EmbeddingCache(cache_dir, self.model, self.dim)
+        self.encoding_format = encoding_format
+        self.controller = AdaptiveConcurrency() if controller is None else controller
         
     def _encode_image(self, image, resize=True):
         """ Resize image, encode as jpeg to shrink size then convert to b64 for upload """
-
-        if isinstance(image, str): #file path
-            image = Image.open(image).convert("RGB")
-        elif isinstance(image, Image.Image): #pil image 
-            image = image.convert("RGB")
-        elif isinstance(image, np.ndarray): #cv2 / np array image 
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            image = Image.fromarray(image)
-        else:
-            print(f"Unsupported image input: {type(image)}")
-            return None 
-            
-        if resize:
-            image = image.resize((336,336)) #could also centercrop or pad square and resize 
-
-        buf = io.BytesIO() #temporary buffer to save processed image 
-        image.save(buf, format="JPEG")
-        image = buf.getvalue()
-        image_b64 = base64.b64encode(image).decode()
-        return image_b64
+        return encode_image(image, size=(336,336) if resize else None)
 
 
     def _combine_responses(self, responses):
@@ -79,32 +74,259 @@ class NVCLIP:
 
         return combined_responses
 
-    def __call__(self, items, chunk=64, workers=16, resize=True):
-        """Embed images or text. Items should be a list of string or local filepaths to images. The items are chunked and spread across N worker threads. NVCLIP will accept upto 64 items in one request. """
+    def _decode_embedding(self, embedding):
+        """Embeddings come back as a list of floats or, with encoding_format="base64", as b64 little endian float32."""
+        if isinstance(embedding, str):
+            return np.frombuffer(base64.b64decode(embedding), dtype="<f4")
+        return embedding
+
+    def _build_payload(self, item_chunk, resize=True, encoding_format=None):
+        """Build the request payload for one chunk of items. Local image paths, PIL images and np arrays are encoded to b64, everything else is sent as text."""
+        embed_items = list(item_chunk)
+        image_idx = [i for i, item in enumerate(item_chunk) if isinstance(item, (Image.Image, np.ndarray)) or is_file_item(item)]
+        image_items = [item_chunk[i] for i in image_idx]
+        if self.preprocessor is not None:
+            encoded = self.preprocessor.map(image_items, size=(336,336) if resize else None)
+        else:
+            encoded = [self._encode_image(item, resize=resize) for item in image_items]
+        for i, image_b64 in zip(image_idx, encoded):
+            embed_items[i] = f"data:image/jpeg;base64,{image_b64}" #image, strings are left as is 
+        payload = {"input": embed_items, "model":self.model}
+        if encoding_format is not None and encoding_format != "float":
+            payload["encoding_format"] = encoding_format
+        return payload
+
+    def _cache_settings(self, resize):
+        """Preprocessing settings that change the embedding of an image. Part of the cache key."""
+        return "336x336" if resize else "original"
+
+    def _split_cached(self, items, resize, digests=None):
+        """Check the cache for each item. Returns the cache keys, the cached vectors (None for a miss) and the indices that still need a request.
+        digests optionally holds the file_hash of each item so files are not read again for the key."""
+        digests = digests or [None] * len(items)
+        keys = [self.cache.key(item, self._cache_settings(resize), digest) for item, digest in zip(items, digests)]
+        cached = self.cache.get(keys)
+        miss_idx = [i for i, vector in enumerate(cached) if vector is None]
+        return keys, cached, miss_idx
+
+    def _merge_cached(self, keys, cached, miss_idx, response):
+        """Store newly embedded items in the cache and splice the cached hits back into one combined response."""
+        if response is None: #every item was cached 
+            usage = {"num_images": 0, "prompt_tokens": 0, "total_tokens": 0}
+            response = {"object":"list", "data":[], "usage":usage, "model":self.model}
+
+        self.cache.put([keys[i] for i in miss_idx], [data["embedding"] for data in response["data"]])
+        for i, data in zip(miss_idx, response["data"]):
+            cached[i] = data["embedding"]
+
+        response["data"] = [
+            {"object":"embedding", "index":i, "embedding":vector if isinstance(vector, list) else vector.tolist()}
+            for i, vector in enumerate(cached)
+        ]
+        return response
+
+    def __call__(self, items, chunk=64, workers=None, resize=True, return_numpy=False, digests=None, progress=True):
+        """Embed images or text. Items should be a list of string or local filepaths to images. The items are chunked and spread across N worker threads. NVCLIP will accept upto 64 items in one request.
+        By default there is a thread per request the controller may allow, set workers to use fewer.
+        With return_numpy=True the embeddings are returned as an (N, 1024) float32 array instead of the combined JSON response.
+        digests is an optional file_hash per item, used for the cache key when the caller already hashed the files.
+        progress=False skips the cache stats and progress bars, e.g. for search queries and background ingestion. """
+
+        workers = workers or self.controller.max_limit
+        if return_numpy:
+            out = np.empty((len(items), self.dim), dtype=np.float32)
+            if self.cache is None:
+                self._embed_chunks_numpy(items, np.arange(len(items)), out, chunk, workers, resize, progress)
+                return out
+
+            keys, cached, miss_idx = self._split_cached(items, resize, digests)
+            if progress:
+                print(f"{len(items) - len(miss_idx)} of {len(items)} embeddings found in cache")
+            for i, vector in enumerate(cached):
+                if vector is not None:
+                    out[i] = vector
+            if len(miss_idx) > 0:
+                self._embed_chunks_numpy([items[i] for i in miss_idx], np.asarray(miss_idx), out, chunk, workers, resize, progress)
+                self.cache.put([keys[i] for i in miss_idx], out[miss_idx])
+            return out
+
+        if self.cache is None:
+            return self._embed_chunks(items, chunk, workers, resize, progress)
+
+        keys, cached, miss_idx = self._split_cached(items, resize, digests)
+        if progress:
+            print(f"{len(items) - len(miss_idx)} of {len(items)} embeddings found in cache")
+        response = None
+        if len(miss_idx) > 0:
+            response = self._embed_chunks([items[i] for i in miss_idx], chunk, workers, resize, progress)
+        return self._merge_cached(keys, cached, miss_idx, response)
+
+    def _embed_chunks(self, items, chunk, workers, resize, progress=True):
+        """Send all items to NVCLIP, chunk items per request and workers requests at a time."""
     
         with ThreadPoolExecutor(max_workers=workers) as executor:
 
             responses = []
             futures = []
-            print("Submitting Requests")
-            for i in tqdm(range(0,len(items),chunk)):
+            if progress:
+                print("Submitting Requests")
+            for i in tqdm(range(0,len(items),chunk), disable=not progress):
                 item_chunk = items[i:min(len(items), i+chunk)] #each request will send chunk number of items 
-                embed_items = []
-                for item in item_chunk:
-                    if os.path.isfile(item):
-                        embed_items.append(f"data:image/jpeg;base64,{self._encode_image(item, resize=resize)}") #image 
-                    else:
-                        embed_items.append(item) #string 
-                payload = {"input": embed_items, "model":"nvidia/nvclip"}
-                future = executor.submit(requests.post, self.base_url, headers=self.headers, json=payload)
+                payload = self._build_payload(item_chunk, resize=resize)
+                future = executor.submit(request_with_retry, self.controller, "post", self.base_url, headers=self.headers, json=payload)
                 futures.append(future)
                 
-            print("Collecting Responses")
-            for future in tqdm(futures):
-                responses.append(future.result().json())
+            if progress:
+                print("Collecting Responses")
+            for future in tqdm(futures, disable=not progress):
+                response = future.result()
+                response.raise_for_status()
+                responses.append(response.json())
 
         return self._combine_responses(responses) #combine all responses and return 
 
+    def _embed_chunks_numpy(self, items, rows, out, chunk, workers, resize, progress=True):
+        """Send all items to NVCLIP and write embedding i straight into out[rows[i]] as each response is parsed."""
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            if progress:
+                print("Submitting Requests")
+            for i in tqdm(range(0,len(items),chunk), disable=not progress):
+                item_chunk = items[i:min(len(items), i+chunk)]
+                payload = self._build_payload(item_chunk, resize=resize, encoding_format=self.encoding_format)
+                futures.append((i, len(item_chunk), executor.submit(request_with_retry, self.controller, "post", self.base_url, headers=self.headers, json=payload)))
+
+            if progress:
+                print("Collecting Responses")
+            for start, size, future in tqdm(futures, disable=not progress):
+                response = future.result()
+                response.raise_for_status()
+                data = response.json()["data"]
+                if len(data) != size:  # out is uninitialized, a short response would leave garbage rows
+                    raise Exception(f"Expected {size} embeddings, received {len(data)}")
+                for x in data:
+                    out[rows[start + x["index"]]] = self._decode_embedding(x["embedding"])
+        return out
+
+    def _post_chunk(self, session, indices, keys, payload):
+        """Send one chunk and return the input indices and cache keys of its items with the parsed response."""
+        response = request_with_retry(self.controller, "post", self.base_url, session=session, headers=self.headers, json=payload)
+        response.raise_for_status()
+        return indices, keys, response.json()
+
+    def iter_embeddings(self, items, chunk=64, workers=None, resize=True):
+        """Stream embeddings for an iterable of strings or image paths. Yields (index, embedding) tuples in the order responses arrive, where index is the position of the item in the input.
+        While up to `workers` chunks are in flight the next chunk is being encoded, and only that many chunks are ever held in memory so the input can be arbitrarily large."""
+
+        workers = workers or self.controller.max_limit
+        items = enumerate(items)
+        settings = self._cache_settings(resize)
+        session = requests.Session() #reuse connections between chunks 
+        session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=workers))
+        session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=workers))
+
+        with session, ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = set()
+            exhausted = False
+            while in_flight or not exhausted:
+                #top up the pipeline. encoding happens here while earlier chunks are uploading 
+                ready = [] #cache hits, yielded without a request 
+                while not exhausted and len(in_flight) < workers and len(ready) < chunk:
+                    indices, item_chunk, keys = [], [], []
+                    for index, item in items:
+                        if self.cache is not None:
+                            key = self.cache.key(item, settings)
+                            vector = self.cache.get([key])[0]
+                            if vector is not None:
+                                ready.append((index, vector.tolist()))
+                                if len(ready) == chunk:
+                                    break
+                                continue
+                            keys.append(key)
+                        indices.append(index)
+                        item_chunk.append(item)
+                        if len(item_chunk) == chunk:
+                            break
+                    else:
+                        exhausted = True
+
+                    if len(item_chunk) > 0:
+                        payload = self._build_payload(item_chunk, resize=resize)
+                        in_flight.add(executor.submit(self._post_chunk, session, indices, keys, payload))
+
+                yield from ready
+                if not in_flight:
+                    continue
+
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    indices, keys, response = future.result()
+                    if self.cache is not None:
+                        self.cache.put([keys[data["index"]] for data in response["data"]], [data["embedding"] for data in response["data"]])
+                    for data in response["data"]:
+                        yield indices[data["index"]], data["embedding"]
+
+    def _make_session(self, concurrency):
+        """Create a keep-alive HTTP session sized for the number of in-flight requests."""
+        connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=60)
+        return aiohttp.ClientSession(headers=self.headers, connector=connector)
+
+    async def embed_async(self, items, chunk=64, concurrency=None, resize=True, session=None):
+        """Async version of __call__. All chunks share one keep-alive session and at most `concurrency` requests (by default the controller's maximum) are in flight at once.
+        Pass in an existing aiohttp session to reuse its connections across calls. Returns the same combined response as __call__."""
+
+        concurrency = concurrency or self.controller.max_limit
+        if self.cache is not None:
+            keys, cached, miss_idx = self._split_cached(items, resize)
+            response = None
+            if len(miss_idx) > 0:
+                response = await self._embed_chunks_async([items[i] for i in miss_idx], chunk, concurrency, resize, session)
+            return self._merge_cached(keys, cached, miss_idx, response)
+        return await self._embed_chunks_async(items, chunk, concurrency, resize, session)
+
+    async def _embed_chunks_async(self, items, chunk, concurrency, resize, session):
+        """Send all items to NVCLIP over one session, chunk items per request. A producer encodes chunks as the queue drains and
+        `concurrency` consumers post them, so at most about 2 * concurrency encoded payloads are held in memory at once."""
+        owns_session = session is None
+        if owns_session:
+            session = self._make_session(concurrency)
+
+        queue = asyncio.Queue(maxsize=concurrency)
+        starts = range(0, len(items), chunk)
+        responses = [None] * len(starts)
+
+        async def produce():
+            for n, i in enumerate(starts):
+                item_chunk = items[i:min(len(items), i+chunk)]
+                #image encoding is CPU bound so keep it off the event loop 
+                payload = await asyncio.to_thread(self._build_payload, item_chunk, resize)
+                await queue.put((n, payload))
+            for _ in range(concurrency): #one stop marker per consumer 
+                await queue.put(None)
+
+        async def consume():
+            while (job := await queue.get()) is not None:
+                n, payload = job
+                responses[n] = await request_with_retry_async(self.controller, session, "post", self.base_url, json=payload)
+
+        tasks = [asyncio.create_task(produce())] + [asyncio.create_task(consume()) for _ in range(concurrency)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks: #do not leave requests running on a closed session 
+                task.cancel()
+            raise
+        finally:
+            if owns_session:
+                await session.close()
+
+        return self._combine_responses(responses)
+
+    def embed(self, items, chunk=64, concurrency=None, resize=True):
+        """Blocking wrapper around embed_async for callers without an event loop."""
+        return asyncio.run(self.embed_async(items, chunk=chunk, concurrency=concurrency, resize=resize))
+
 
 if __name__ == "__main__":
     """Example Usage"""
@@ -114,3 +336,7 @@ if __name__ == "__main__":
     response = nvclip(input, workers=4)
     print(f"Time: {time() - start}")
     print(response)
+
+    start = time()
+    response = nvclip.embed(input, concurrency=4)
+    print(f"Time (async): {time() - start}")
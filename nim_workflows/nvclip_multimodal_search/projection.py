@@ -0,0 +1,211 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from pathlib import Path
+from threading import Thread
+
+import numpy as np
+from sklearn.manifold import TSNE
+
+
+def projection_path_for(db_name):
+    """The 2D projection is cached next to the Milvus Lite db file."""
+    return str(Path(db_name).with_suffix(".projection.npz"))
+
+
+def _signature(vectors, block=65536):
+    """Cheap per row checksum used to detect vectors that changed under the same id. Computed block by block so a memory mapped
+    matrix is never copied into memory as a whole."""
+    rng = np.random.default_rng(0)
+    r = rng.standard_normal((vectors.shape[1], 4))
+    signature = np.empty((len(vectors), 4), dtype=np.float64)
+    for start in range(0, len(vectors), block):
+        signature[start : start + block] = np.asarray(vectors[start : start + block], dtype=np.float64) @ r
+    return signature
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def fit_pca(vectors, n_components=2, oversample=8, n_iter=4, block=65536, seed=0):
+    """Instant layout by randomized PCA of the normalized vectors. Runs a few blocked subspace iterations, so it only needs
+    a handful of passes over the data and works directly on a memory map."""
+    n, d = vectors.shape
+    if n < 2:
+        return np.zeros((n, n_components), dtype=np.float32)
+    rng = np.random.default_rng(seed)
+
+    def blocks(mean=0):
+        for start in range(0, n, block):
+            yield _normalize(np.asarray(vectors[start : start + block], dtype=np.float32)) - mean
+
+    mean = sum(x.sum(axis=0) for x in blocks()) / n
+    q = rng.standard_normal((d, n_components + oversample)).astype(np.float32)
+    for _ in range(n_iter):
+        z = np.zeros_like(q)
+        for x in blocks(mean):
+            z += x.T @ (x @ q)
+        q, _ = np.linalg.qr(z)
+
+    small = np.zeros((q.shape[1], q.shape[1]), dtype=np.float64)
+    for x in blocks(mean):
+        y = x @ q
+        small += y.T @ y
+    _, eigenvectors = np.linalg.eigh(small)  # ascending order
+    components = q @ eigenvectors[:, ::-1][:, :n_components].astype(np.float32)
+    return np.concatenate([x @ components for x in blocks(mean)])
+
+
+def fit_tsne(vectors, init=None, n_jobs=-1):
+    """Full cosine t-SNE of all vectors. Uses openTSNE (FFT accelerated) if it is installed, otherwise multi-threaded Barnes-Hut t-SNE
+    from scikit-learn. init is an optional starting layout, e.g. from fit_pca, so the refined layout keeps its overall shape."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    perplexity = min(20, len(vectors) - 1)
+    if init is not None:  # t-SNE expects a starting layout with a small spread
+        init = np.asarray(init, dtype=np.float32) / max(np.std(init[:, 0]), 1e-12) * 1e-4
+
+    try:
+        from openTSNE import TSNE as OpenTSNE
+
+        tsne = OpenTSNE(
+            n_components=2,
+            perplexity=perplexity,
+            metric="cosine",
+            n_jobs=n_jobs,
+            random_state=42,
+            initialization="pca" if init is None else init,
+        )
+        return np.asarray(tsne.fit(vectors))
+    except ImportError:
+        pass
+
+    tsne = TSNE(
+        n_components=2,
+        perplexity=perplexity,
+        learning_rate=200,
+        early_exaggeration=30,
+        max_iter=2000,
+        random_state=42,
+        metric="cosine",
+        method="barnes_hut",
+        n_jobs=n_jobs,
+        init="pca" if init is None else init,
+    )
+    return tsne.fit_transform(vectors)
+
+
+def place_new(new_vectors, ref_vectors, ref_coords, k=10, block=1024, ref_block=65536):
+    """Out of sample placement. Each new point is put at the similarity weighted mean of its k nearest reference points (cosine).
+    The reference vectors are read block by block, so they can be a memory map that does not fit in memory.
+    Without reference points, e.g. when watching a folder that started empty, the points are scattered around the origin."""
+    if len(ref_vectors) == 0:
+        return np.random.default_rng(0).normal(scale=1e-2, size=(len(new_vectors), 2)).astype(np.float32)
+    new_vectors = _normalize(np.asarray(new_vectors, dtype=np.float32))
+    k = min(k, len(ref_vectors))
+    coords = np.empty((len(new_vectors), 2), dtype=np.float32)
+
+    for start in range(0, len(new_vectors), block):
+        queries = new_vectors[start : start + block]
+        top_sims = np.empty((len(queries), 0), dtype=np.float32)
+        top_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for ref_start in range(0, len(ref_vectors), ref_block):  # running top k over the reference blocks
+            ref = _normalize(np.asarray(ref_vectors[ref_start : ref_start + ref_block], dtype=np.float32))
+            sims = np.concatenate([top_sims, queries @ ref.T], axis=1)
+            rows = np.concatenate(
+                [top_rows, np.broadcast_to(np.arange(ref_start, ref_start + len(ref)), (len(queries), len(ref)))], axis=1
+            )
+            nn = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+            top_sims = np.take_along_axis(sims, nn, axis=1)
+            top_rows = np.take_along_axis(rows, nn, axis=1)
+        weights = np.maximum(top_sims, 0) + 1e-6
+        weights /= weights.sum(axis=1, keepdims=True)
+        coords[start : start + block] = np.einsum("nk,nkd->nd", weights, ref_coords[top_rows])
+    return coords
+
+
+def load_projection(projection_path):
+    if not os.path.exists(projection_path):
+        return None
+    with np.load(projection_path) as f:
+        return {key: f[key] for key in f.files}
+
+
+def save_projection(projection_path, ids, coords, vectors):
+    np.savez(
+        projection_path,
+        ids=np.asarray(ids, dtype=np.int64),
+        coords=np.asarray(coords, dtype=np.float32),
+        signature=_signature(vectors),
+    )
+
+
+def project(ids, vectors, projection_path, max_new_fraction=0.5, on_refined=None):
+    """2D layout for the vectors, reusing the cached layout where possible. Points that are new or whose vector changed since the
+    layout was saved are placed next to their nearest neighbours. t-SNE is only rerun when there is no cache or most points are new.
+    If on_refined is given, t-SNE runs on a background thread: a PCA layout is returned right away and on_refined(ids, coords)
+    is called with the t-SNE layout once it is done, or with coords None if t-SNE failed. Returns the layout, and with on_refined also the background thread (None if no t-SNE is needed)."""
+    ids = np.asarray(ids, dtype=np.int64)
+    cached = load_projection(projection_path)
+
+    if cached is not None and len(ids) > 0:
+        row_of_id = {id: row for row, id in enumerate(cached["ids"].tolist())}
+        cached_rows = np.array([row_of_id.get(id, -1) for id in ids.tolist()])
+        known = cached_rows >= 0
+        signature = _signature(vectors)
+        known[known] = np.all(
+            np.isclose(signature[known], cached["signature"][cached_rows[known]], rtol=1e-5, atol=1e-5),
+            axis=1,
+        )
+
+        if known.all():
+            print("reusing cached 2D projection")
+            coords = cached["coords"][cached_rows]
+            return coords if on_refined is None else (coords, None)
+
+        if known.sum() >= 2 and (~known).mean() <= max_new_fraction:
+            print(f"placing {(~known).sum()} new points in cached 2D projection")
+            coords = np.empty((len(ids), 2), dtype=np.float32)
+            coords[known] = cached["coords"][cached_rows[known]]
+            coords[~known] = place_new(vectors[~known], vectors[known], coords[known])
+            save_projection(projection_path, ids, coords, vectors)
+            return coords if on_refined is None else (coords, None)
+
+    if on_refined is None:
+        print("running t-SNE")
+        coords = fit_tsne(vectors)
+        save_projection(projection_path, ids, coords, vectors)
+        return coords
+
+    coords = fit_pca(vectors)
+    if len(ids) < 3:  # too few points for t-SNE, e.g. an empty folder in watch mode
+        return coords, None
+    print("using PCA layout while t-SNE runs in the background")
+
+    def refine():
+        refined = None
+        try:
+            refined = fit_tsne(vectors, init=coords)
+            save_projection(projection_path, ids, refined, vectors)
+        except Exception as e:  # keep the PCA layout
+            print(f"t-SNE failed: {e}")
+        finally:  # always report back, so nobody keeps waiting for the refined layout
+            on_refined(ids.tolist(), refined)
+
+    thread = Thread(target=refine, daemon=True)
+    thread.start()
+    return coords, thread
@@ -0,0 +1,210 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import numpy as np
+
+from projection import _signature
+
+# number of set bits for every byte value
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.int32)
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def quantize_int8(vectors):
+    """Symmetric per vector int8 quantization. Returns the codes and the scale of each vector."""
+    scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def quantize_binary(vectors):
+    """One sign bit per dimension, packed 8 per byte"""
+    return np.packbits(vectors > 0, axis=1)
+
+
+class QuantizedIndex:
+
+    def __init__(self, vector_file, mode="int8", block=65536):
+        """In process index that searches int8 (4x smaller) or binary (32x smaller) codes held in memory, then re-ranks the
+        best candidates with the exact float32 vectors of a memory mapped VectorFile. Row i of the vector file belongs to the
+        i-th id of the index, the index keeps no copy of the float vectors."""
+        if mode not in ("int8", "binary"):
+            raise Exception(f"Unsupported quantization: {mode}")
+        self.vector_file = vector_file
+        self.mode = mode
+        self.block = block
+        # ids, codes and int8 scales, swapped as one so a concurrent search sees either the old or the new rows
+        self.state = (np.empty(0, dtype=np.int64), *self._empty(0))
+        self.row_of_id = {}
+
+    def _empty(self, n):
+        dim = self.vector_file.dim
+        if self.mode == "int8":
+            return np.empty((n, dim), dtype=np.int8), np.empty(n, dtype=np.float32)
+        return np.empty((n, (dim + 7) // 8), dtype=np.uint8), None
+
+    def _quantize(self, vectors):
+        vectors = _normalize(vectors)
+        if self.mode == "int8":
+            return quantize_int8(vectors)
+        return quantize_binary(vectors), None
+
+    def _fill(self, rows, codes, scales):
+        """Quantize rows of the vector file block by block"""
+        for start in range(0, len(rows), self.block):
+            block = rows[start : start + self.block]
+            block_codes, block_scales = self._quantize(self.vector_file.vectors[block])
+            codes[block] = block_codes
+            if scales is not None:
+                scales[block] = block_scales
+
+    def _set(self, ids, codes, scales):
+        self.row_of_id = {id: row for row, id in enumerate(ids.tolist())}
+        self.state = (ids, codes, scales)
+
+    def build(self, ids):
+        """Quantize every row of the vector file, ids[i] is the id of row i"""
+        ids = np.asarray(ids, dtype=np.int64)
+        codes, scales = self._empty(len(ids))
+        self._fill(np.arange(len(ids)), codes, scales)
+        self._set(ids, codes, scales)
+        return self
+
+    @classmethod
+    def load_or_build(cls, path, vector_file, ids, mode="int8", block=65536):
+        """Index over the vector file that reuses the codes saved at path. Only rows that are new or whose vector changed since
+        the codes were saved are quantized, then the codes are saved again."""
+        index = cls(vector_file, mode, block)
+        ids = np.asarray(ids, dtype=np.int64)
+        codes, scales = index._empty(len(ids))
+        signature = _signature(vector_file.vectors)
+        stale = np.ones(len(ids), dtype=bool)
+
+        cached = None
+        if os.path.exists(path):
+            with np.load(path) as f:
+                cached = {key: f[key] for key in f.files}
+            if str(cached["mode"]) != mode or cached["codes"].shape[1] != codes.shape[1]:
+                cached = None
+        if cached is not None:
+            cached_row_of_id = {id: row for row, id in enumerate(cached["ids"].tolist())}
+            cached_rows = np.array([cached_row_of_id.get(id, -1) for id in ids.tolist()], dtype=np.int64)
+            known = cached_rows >= 0
+            known[known] = np.all(
+                np.isclose(signature[known], cached["signature"][cached_rows[known]], rtol=1e-5, atol=1e-5),
+                axis=1,
+            )
+            codes[known] = cached["codes"][cached_rows[known]]
+            if scales is not None:
+                scales[known] = cached["scales"][cached_rows[known]]
+            stale = ~known
+
+        rows = np.nonzero(stale)[0]
+        if len(rows) > 0:
+            print(f"quantizing {len(rows)} of {len(ids)} vectors")
+            index._fill(rows, codes, scales)
+        index._set(ids, codes, scales)
+        if len(rows) > 0 or cached is None or len(cached["ids"]) != len(ids):
+            extra = {} if scales is None else {"scales": scales}
+            np.savez(path, mode=mode, ids=ids, codes=codes, signature=signature, **extra)
+        return index
+
+    def add(self, ids, vectors):
+        """Add or replace vectors. They must already be written to the vector file: modified ids in their rows, new ids in the
+        rows after the current ones, in the order given."""
+        ids = np.asarray(ids, dtype=np.int64)
+        codes, scales = self._quantize(vectors)
+        old_ids, old_codes, old_scales = self.state
+
+        existing = np.array([id in self.row_of_id for id in ids.tolist()], dtype=bool)
+        if existing.any():  # modified vectors are overwritten in place
+            rows = np.array([self.row_of_id[id] for id in ids[existing].tolist()])
+            old_codes[rows] = codes[existing]
+            if old_scales is not None:
+                old_scales[rows] = scales[existing]
+
+        new = ~existing
+        if new.any():
+            for row, id in enumerate(ids[new].tolist(), start=len(old_ids)):
+                self.row_of_id[id] = row
+            new_scales = None if old_scales is None else np.concatenate([old_scales, scales[new]])
+            self.state = (
+                np.concatenate([old_ids, ids[new]]),
+                np.concatenate([old_codes, codes[new]]),
+                new_scales,
+            )
+
+    def _approximate_scores(self, query, codes, scales):
+        """First pass over the codes. Higher is more similar."""
+        scores = np.empty(len(codes), dtype=np.float32)
+        if self.mode == "int8":
+            q_codes, q_scale = quantize_int8(query[None])
+            q = q_codes[0].astype(np.float32)
+            for start in range(0, len(codes), self.block):
+                block = codes[start : start + self.block].astype(np.float32)
+                scores[start : start + self.block] = (block @ q) * scales[start : start + self.block]
+            scores *= q_scale[0]
+        else:
+            q = quantize_binary(query[None])[0]
+            for start in range(0, len(codes), self.block):
+                xor = np.bitwise_xor(codes[start : start + self.block], q)
+                scores[start : start + self.block] = -POPCOUNT[xor].sum(axis=1)
+        return scores
+
+    def _exact(self, query, ids, rows, k):
+        """Score rows with the exact vectors. Returns (id, cosine similarity) of the best k."""
+        order = np.argsort(rows)  # sequential reads from the memory map
+        ids, rows = ids[order], rows[order]
+        exact = _normalize(self.vector_file.vectors[rows]) @ query
+        best = np.argsort(-exact)[:k]
+        return list(zip(ids[best].tolist(), exact[best].tolist()))
+
+    def search(self, query_vectors, k=20, rerank=200):
+        """Returns a list of (id, cosine similarity) hits per query, best first. rerank candidates from the first pass are scored exactly."""
+        ids, codes, scales = self.state
+        n = len(ids)
+        if n == 0:
+            return [[] for _ in query_vectors]
+
+        results = []
+        for query in _normalize(query_vectors):
+            scores = self._approximate_scores(query, codes, scales)
+            candidates = min(max(rerank, k), n)
+            rows = np.argpartition(-scores, candidates - 1)[:candidates]
+            results.append(self._exact(query, ids[rows], rows, k))
+        return results
+
+    def rerank(self, query_vectors, candidate_ids, k=20):
+        """Exact scores for candidates found elsewhere, e.g. by a filtered search on the binary codes in milvus. candidate_ids
+        holds the candidate ids of each query. Returns a list of (id, cosine similarity) hits per query, best first."""
+        results = []
+        for query, candidates in zip(_normalize(query_vectors), candidate_ids):
+            candidates = [id for id in candidates if id in self.row_of_id]
+            if len(candidates) == 0:
+                results.append([])
+                continue
+            rows = np.array([self.row_of_id[id] for id in candidates], dtype=np.int64)
+            results.append(self._exact(query, np.array(candidates, dtype=np.int64), rows, k))
+        return results
+
+    def memory_bytes(self):
+        """Bytes held in memory for the first pass"""
+        return sum(x.nbytes for x in self.state if x is not None)
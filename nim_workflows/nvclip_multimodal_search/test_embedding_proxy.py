@@ -0,0 +1,52 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import aiohttp
+
+import embedding_proxy
+from embedding_proxy import MicroBatcher
+
+
+def test_bad_input_fails_only_its_caller(monkeypatch):
+    sent = []
+
+    async def fake_request(controller, session, method, url, json=None, **kwargs):
+        sent.append(list(json["input"]))
+        if "bad" in json["input"]:
+            raise aiohttp.ClientResponseError(None, (), status=400, message="invalid input")
+        return {"model": "nvclip", "data": [{"index": i, "embedding": [len(x)]} for i, x in enumerate(json["input"])]}
+
+    monkeypatch.setattr(embedding_proxy, "request_with_retry_async", fake_request)
+
+    async def run():
+        batcher = MicroBatcher("http://upstream/v1/embeddings", "key", max_wait_ms=50)
+        await batcher.start()
+        try:
+            return await asyncio.gather(
+                batcher.embed({"input": ["a", "bb"]}),
+                batcher.embed({"input": "bad"}),
+                batcher.embed({"input": ["cccc"]}),
+                return_exceptions=True,
+            )
+        finally:
+            await batcher.close()
+
+    good, bad, other = asyncio.run(run())
+    assert sent[0] == ["a", "bb", "bad", "cccc"]  # merged into one upstream request first
+    assert good == ([[1], [2]], "nvclip")
+    assert other == ([[4]], "nvclip")
+    assert isinstance(bad, aiohttp.ClientResponseError) and bad.status == 400
@@ -0,0 +1,34 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from quantized_index import QuantizedIndex
+
+
+@pytest.mark.parametrize("mode", ["int8", "binary"])
+def test_exact_match_first(mode):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((2000, 256)).astype(np.float32)
+    vector_file = SimpleNamespace(vectors=vectors, dim=vectors.shape[1])
+    index = QuantizedIndex(vector_file, mode=mode).build(np.arange(1000, 3000))
+
+    queries = vectors[:5] + 0.05 * rng.standard_normal((5, 256)).astype(np.float32)
+    results = index.search(queries, k=5, rerank=50)
+    assert [hits[0][0] for hits in results] == [1000, 1001, 1002, 1003, 1004]
+    assert all(hits[0][1] > 0.99 for hits in results)
@@ -0,0 +1,125 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+from fastapi.staticfiles import StaticFiles
+
+THUMBNAIL_NAME = re.compile(r"^[0-9a-f]{40}\.webp$")
+CACHE_FOREVER = "public, max-age=31536000, immutable"
+
+
+def make_thumbnail(src, dst, size=256, quality=80):
+    """Downscale one image to fit in size x size and save as webp. Returns False if the image could not be read."""
+    try:
+        image = Image.open(src)
+        image.draft("RGB", (size, size))  # decode jpegs at reduced size
+        image = image.convert("RGB")
+        image.thumbnail((size, size))
+        tmp = dst + ".tmp"
+        image.save(tmp, format="WEBP", quality=quality)
+        os.replace(tmp, dst)
+        return True
+    except (OSError, ValueError) as e:
+        print(f"Could not create thumbnail for {src}: {e}")
+        return False
+
+
+class ThumbnailStore:
+
+    def __init__(self, folder, size=256, quality=80, workers=None):
+        """Pre-generated webp thumbnails. A thumbnail's name is derived from the source path, size and mtime,
+        so a thumbnail URL never changes content and can be cached by browsers indefinitely."""
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.size = size
+        self.quality = quality
+        self.workers = workers
+
+    def name_for(self, path):
+        st = os.stat(path)
+        key = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}|{self.size}"
+        return hashlib.sha1(key.encode()).hexdigest() + ".webp"
+
+    def path_for(self, path):
+        return str(self.folder / self.name_for(path))
+
+    def build(self, paths):
+        """Create any missing thumbnails on a process pool. Returns the number created."""
+        todo = [(p, self.path_for(p)) for p in paths if os.path.isfile(p)]
+        todo = [(src, dst) for src, dst in todo if not os.path.exists(dst)]
+        if len(todo) == 0:
+            return 0
+
+        print(f"creating {len(todo)} thumbnails")
+        n = len(todo)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            created = executor.map(
+                make_thumbnail,
+                [src for src, _ in todo],
+                [dst for _, dst in todo],
+                [self.size] * n,
+                [self.quality] * n,
+                chunksize=max(1, n // 64),
+            )
+            return sum(created)
+
+    def prune(self, paths):
+        """Delete thumbnails of images that are not in paths, e.g. of modified or deleted files. Returns the number deleted."""
+        keep = set()
+        for path in paths:
+            try:
+                keep.add(self.name_for(path))
+            except OSError:  # deleted since it was indexed
+                pass
+        removed = 0
+        for thumbnail in self.folder.glob("*.webp"):
+            if thumbnail.name not in keep:
+                thumbnail.unlink(missing_ok=True)
+                removed += 1
+        if removed > 0:
+            print(f"removed {removed} stale thumbnails")
+        return removed
+
+    def serve(self, name, request: Request):
+        """FastAPI handler for /thumbs/{name}. Answers conditional requests with 304 so revisited result pages cost nothing."""
+        if not THUMBNAIL_NAME.match(name):
+            return Response(status_code=404)
+        path = self.folder / name
+        if not path.exists():
+            return Response(status_code=404)
+
+        st = path.stat()
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        headers = {"ETag": etag, "Cache-Control": CACHE_FOREVER}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return FileResponse(path, media_type="image/webp", headers=headers)
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles already sends ETag and Last-Modified. This also lets browsers reuse full size images for a day without revalidating."""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=86400"
+        return response
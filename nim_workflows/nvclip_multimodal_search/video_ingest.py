@@ -0,0 +1,164 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import hashlib
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from discovery import ImagePath, walk_videos, file_hash
+from index_sync import remove_files, upsert_rows
+
+
+def keyframe_dir_for(db_name):
+    """Keyframes are saved next to the Milvus Lite db file."""
+    return str(Path(db_name).with_suffix(".keyframes"))
+
+
+def select_keyframes(video_path, sample_fps=2.0, hist_threshold=0.3, diff_threshold=0.12, max_gap_s=30.0):
+    """Yield (timestamp in seconds, BGR frame) for the frames where the scene changes. Frames are sampled at sample_fps and compared
+    to the last keyframe by HSV histogram (Bhattacharyya distance) and mean absolute difference of a small grayscale copy.
+    A keyframe is also taken every max_gap_s seconds so slow changes are not missed."""
+    cap = cv2.VideoCapture(str(video_path))
+    if not cap.isOpened():
+        raise Exception(f"Could not open video {video_path}")
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    step = max(1, round(fps / sample_fps))
+
+    last_hist, last_gray, last_t = None, None, None
+    index = 0
+    try:
+        while cap.grab():  # grab without decoding the skipped frames
+            if index % step == 0:
+                ok, frame = cap.retrieve()
+                if not ok:
+                    break
+                t = index / fps
+                small = cv2.resize(frame, (64, 36), interpolation=cv2.INTER_AREA)
+                hist = cv2.calcHist(
+                    [cv2.cvtColor(small, cv2.COLOR_BGR2HSV)], [0, 1], None, [16, 8], [0, 180, 0, 256]
+                )
+                cv2.normalize(hist, hist)
+                gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+                if last_hist is None:
+                    changed = True
+                else:
+                    hist_distance = cv2.compareHist(last_hist, hist, cv2.HISTCMP_BHATTACHARYYA)
+                    frame_difference = np.abs(gray - last_gray).mean() / 255
+                    changed = (
+                        hist_distance > hist_threshold
+                        or frame_difference > diff_threshold
+                        or t - last_t >= max_gap_s
+                    )
+                if changed:
+                    last_hist, last_gray, last_t = hist, gray, t
+                    yield t, frame
+            index += 1
+    finally:
+        cap.release()
+
+
+def ingest_video(client, nvclip, video_path, manifest, keyframe_dir, collection_name="collection", **sampling):
+    """Extract the keyframes of a video, save them as jpegs and embed them. Each keyframe becomes a row with video and timestamp fields.
+    A previously ingested version of the video is replaced. Returns the primary keys, keyframe paths and embeddings."""
+    entries = manifest["entries"]
+    out_dir = Path(keyframe_dir) / hashlib.sha1(os.path.abspath(video_path).encode()).hexdigest()[:16]
+    if video_path in entries:
+        remove_files(client, [video_path], manifest, collection_name)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    out_dir.mkdir(parents=True)
+
+    timestamps, keyframes = [], []
+    for t, frame in select_keyframes(video_path, **sampling):
+        path = str(out_dir / f"{int(t * 1000):010d}.jpg")
+        cv2.imwrite(path, frame)
+        timestamps.append(t)
+        keyframes.append(ImagePath(path))
+    if len(keyframes) == 0:
+        print(f"No frames decoded from {video_path}")
+        return [], [], None
+
+    ids = list(range(manifest["next_id"], manifest["next_id"] + len(keyframes)))
+    manifest["next_id"] += len(keyframes)
+    vectors = nvclip(keyframes, return_numpy=True)
+    # keyframes are dated by the video. Without container metadata the mtime of the video is used as its start time
+    video_st = os.stat(video_path)
+    metadata = [
+        {
+            "video": str(video_path),
+            "timestamp": t,
+            "capture_time": int(video_st.st_mtime + t),
+            "folder": Path(video_path).parent.as_posix(),
+            "file_size": video_st.st_size,
+        }
+        for t in timestamps
+    ]
+    upsert_rows(client, collection_name, ids, keyframes, vectors, metadata)
+
+    entries[video_path] = {
+        "size": video_st.st_size,
+        "mtime": video_st.st_mtime,
+        "hash": file_hash(video_path),
+        "ids": ids,
+        "timestamps": timestamps,
+        "keyframes": [str(x) for x in keyframes],
+    }
+    return ids, keyframes, vectors
+
+
+def sync_videos(client, nvclip, folder, manifest, keyframe_dir, collection_name="collection", **sampling):
+    """Bring the keyframes in the collection in line with the videos in the folder tree. Works like the image sync, but a video entry in
+    the manifest holds the keys of all its keyframes."""
+    entries = manifest["entries"]
+    seen = set()
+    todo = []
+    for path, st in walk_videos(folder):
+        seen.add(path)
+        entry = entries.get(path)
+        if entry is None:
+            todo.append(path)
+        elif entry["size"] != st.st_size or entry["mtime"] != st.st_mtime:
+            if file_hash(path) == entry["hash"]:
+                entry["size"], entry["mtime"] = st.st_size, st.st_mtime
+            else:
+                todo.append(path)
+
+    removed = [path for path, entry in entries.items() if "ids" in entry and path not in seen]
+    print(f"video sync: {len(todo)} new or changed, {len(removed)} removed")
+    for path in removed:
+        for keyframe in entries[path]["keyframes"]:
+            Path(keyframe).unlink(missing_ok=True)
+    remove_files(client, removed, manifest, collection_name)
+
+    for path in todo:
+        try:
+            ids, _, _ = ingest_video(client, nvclip, path, manifest, keyframe_dir, collection_name, **sampling)
+            print(f"{path}: {len(ids)} keyframes")
+        except Exception as e:  # keep going, the video is retried on the next sync
+            print(f"Failed to ingest video {path}: {e}")
+    return manifest
+
+
+def keyframes_by_id(manifest):
+    """Map the primary key of every keyframe to its (video, timestamp)"""
+    keyframes = {}
+    for path, entry in manifest["entries"].items():
+        for id, t in zip(entry.get("ids", []), entry.get("timestamps", [])):
+            keyframes[id] = (path, t)
+    return keyframes
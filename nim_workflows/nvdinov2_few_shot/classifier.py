@@ -0,0 +1,161 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from threading import Lock
+
+import numpy as np
+
+
+def _normalize(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+class FewShotClassifier:
+
+    def __init__(self, dim, mode="knn", k=5, grow_by=1024):
+        """In memory few shot classifier over normalized embeddings. The support set is one contiguous float32 matrix, so classifying
+        a batch is a single matrix multiplication. mode is "knn" (distance weighted vote of the k most similar samples) or
+        "prototype" (most similar class centroid)."""
+        if mode not in ("knn", "prototype"):
+            raise Exception(f"Unsupported mode: {mode}")
+        self.dim = dim
+        self.mode = mode
+        self.k = k
+        self.grow_by = grow_by
+
+        self.vectors = np.empty((0, dim), dtype=np.float32)  # first n rows are in use
+        self.n = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.codes = np.empty(0, dtype=np.int32)  # class index of each row
+        self.row_of_id = {}
+        self.classes = []
+        self.code_of_class = {}
+        self.class_sums = np.empty((0, dim), dtype=np.float32)  # running sums for the prototypes
+        self.class_counts = np.empty(0, dtype=np.int64)
+        self.next_id = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return self.n
+
+    def _code(self, label):
+        code = self.code_of_class.get(label)
+        if code is None:
+            code = len(self.classes)
+            self.classes.append(label)
+            self.code_of_class[label] = code
+            self.class_sums = np.vstack([self.class_sums, np.zeros((1, self.dim), dtype=np.float32)])
+            self.class_counts = np.append(self.class_counts, 0)
+        return code
+
+    def _reserve(self, rows):
+        """Grow the row storage geometrically so adds are amortized O(1) per row"""
+        if self.n + rows <= len(self.vectors):
+            return
+        capacity = max(self.n + rows, 2 * len(self.vectors), self.grow_by)
+        for name, dtype, shape in (
+            ("vectors", np.float32, (capacity, self.dim)),
+            ("ids", np.int64, (capacity,)),
+            ("codes", np.int32, (capacity,)),
+        ):
+            grown = np.empty(shape, dtype=dtype)
+            grown[: self.n] = getattr(self, name)[: self.n]
+            setattr(self, name, grown)
+
+    def add(self, embeddings, labels, ids=None):
+        """Add support samples. labels is one label per embedding or a single label for all. Returns the ids of the samples."""
+        vectors = _normalize(embeddings)
+        if isinstance(labels, str):
+            labels = [labels] * len(vectors)
+        if ids is None:
+            ids = range(self.next_id, self.next_id + len(vectors))
+        ids = [int(x) for x in ids]
+
+        with self.lock:
+            if any(id in self.row_of_id for id in ids):
+                raise Exception("Sample ids must be unique")
+            codes = np.array([self._code(x) for x in labels], dtype=np.int32)
+            self._reserve(len(vectors))
+            rows = slice(self.n, self.n + len(vectors))
+            self.vectors[rows] = vectors
+            self.ids[rows] = ids
+            self.codes[rows] = codes
+            for row, id in enumerate(ids, start=self.n):
+                self.row_of_id[id] = row
+            self.n += len(vectors)
+            np.add.at(self.class_sums, codes, vectors)
+            np.add.at(self.class_counts, codes, 1)
+            self.next_id = max([self.next_id] + [id + 1 for id in ids])
+        return ids
+
+    def remove(self, ids):
+        """Remove support samples by id. The last row is moved into each hole so the matrix stays contiguous."""
+        with self.lock:
+            for id in ids:
+                row = self.row_of_id.pop(int(id), None)
+                if row is None:
+                    continue
+                code = self.codes[row]
+                self.class_sums[code] -= self.vectors[row]
+                self.class_counts[code] -= 1
+
+                last = self.n - 1
+                if row != last:
+                    self.vectors[row] = self.vectors[last]
+                    self.ids[row] = self.ids[last]
+                    self.codes[row] = self.codes[last]
+                    self.row_of_id[int(self.ids[row])] = row
+                self.n -= 1
+
+    def kneighbors(self, embeddings, k=None):
+        """The k most similar support samples of each embedding. Returns ids and cosine similarities, most similar first."""
+        with self.lock:
+            return self._kneighbors(_normalize(embeddings), k or self.k)[::2]
+
+    def _kneighbors(self, queries, k):
+        k = min(k, self.n)
+        sims = queries @ self.vectors[: self.n].T
+        rows = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        top = np.take_along_axis(sims, rows, axis=1)
+        order = np.argsort(-top, axis=1)
+        rows = np.take_along_axis(rows, order, axis=1)
+        return self.ids[rows], rows, np.take_along_axis(top, order, axis=1)
+
+    def predict(self, embeddings, mode=None, k=None):
+        """Classify a batch of embeddings. Returns one label and one score in [0, 1] per embedding.
+        In knn mode the score is the share of the neighbour weight that voted for the label, in prototype mode it is the cosine similarity to the centroid."""
+        mode = mode or self.mode
+        queries = _normalize(embeddings)
+        with self.lock:
+            if self.n == 0:
+                raise Exception("The classifier has no samples")
+            if mode == "knn":
+                _, rows, sims = self._kneighbors(queries, k or self.k)
+                weights = np.maximum(sims, 0) + 1e-6  # similarity weighted vote
+                votes = np.zeros((len(queries), len(self.classes)), dtype=np.float32)
+                np.add.at(votes, (np.arange(len(queries))[:, None], self.codes[rows]), weights)
+                scores = votes / votes.sum(axis=1, keepdims=True)
+            elif mode == "prototype":
+                present = self.class_counts > 0
+                prototypes = _normalize(self.class_sums)
+                scores = queries @ prototypes.T
+                scores[:, ~present] = -np.inf
+            else:
+                raise Exception(f"Unsupported mode: {mode}")
+
+            codes = scores.argmax(axis=1)
+            labels = [self.classes[x] for x in codes]
+        return labels, np.clip(scores[np.arange(len(queries)), codes], 0, 1)
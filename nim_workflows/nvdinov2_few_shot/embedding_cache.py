@@ -0,0 +1,160 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import hashlib
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:  # windows, appends are only serialized within the process
+    fcntl = None
+
+KEY_BYTES = 65  # sha256 hex digest and a newline. Row i of the vectors belongs to the key at offset i * KEY_BYTES
+
+
+class EmbeddingCache:
+
+    def __init__(self, cache_dir, model, dim, grow_by=4096):
+        """Disk backed embedding cache. Vectors are stored as rows of a memory mapped float32 matrix and keys.txt holds the fixed width content key of each row.
+        The cache folder can be shared by several processes, appends are serialized with a file lock.
+        Each model gets its own sub folder since embedding dimensions differ between models."""
+        self.model = model
+        self.dim = dim
+        self.grow_by = grow_by
+        self.folder = Path(cache_dir) / model.replace("/", "_")
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.vector_path = self.folder / "vectors.f32"
+        self.key_path = self.folder / "keys.txt"
+        self.lock = Lock()
+        self.lock_path = self.folder / "lock"
+        self.index = {}
+        self.rows = 0
+        self.vectors = None
+        self.capacity = 0
+
+        self.vector_path.touch(exist_ok=True)
+        self.key_path.touch(exist_ok=True)
+        with self._file_lock():
+            # a crash can leave a partial key at the end of the file. Drop it so the next append starts on a record boundary
+            size = os.path.getsize(self.key_path)
+            if size % KEY_BYTES != 0:
+                with open(self.key_path, "r+b") as f:
+                    f.truncate(size - size % KEY_BYTES)
+            capacity = os.path.getsize(self.vector_path) // (4 * dim)
+            if capacity < os.path.getsize(self.key_path) // KEY_BYTES:
+                raise Exception(f"Embedding cache at {self.folder} is corrupt. Delete the folder to rebuild it.")
+            self._map(max(capacity, grow_by))
+            self._refresh()
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive lock across processes sharing the cache folder, e.g. the indexer and the search app"""
+        with open(self.lock_path, "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Read keys appended since the last refresh, including those written by other processes. Only whole records are read.
+        Rows are written before their key so any key read here points at a complete row."""
+        rows = os.path.getsize(self.key_path) // KEY_BYTES
+        if rows <= self.rows:
+            return
+        with self.key_path.open("rb") as f:
+            f.seek(self.rows * KEY_BYTES)
+            data = f.read((rows - self.rows) * KEY_BYTES)
+        for row in range(self.rows, rows):
+            offset = (row - self.rows) * KEY_BYTES
+            self.index[data[offset : offset + KEY_BYTES - 1].decode()] = row
+        self.rows = rows
+        if rows > self.capacity:  # grown by another process
+            self._map(max(rows, os.path.getsize(self.vector_path) // (4 * self.dim)))
+
+    def _map(self, capacity):
+        """(Re)map the vector file, growing it on disk to hold capacity rows."""
+        if self.vectors is not None:
+            self.vectors.flush()
+            del self.vectors
+        with open(self.vector_path, "r+b") as f:
+            f.truncate(max(os.path.getsize(self.vector_path), capacity * self.dim * 4))
+        self.capacity = capacity
+        self.vectors = np.memmap(
+            self.vector_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim)
+        )
+
+    def key(self, item, settings=""):
+        """Content key for a text string, image path, PIL image or np array. Includes the model name and preprocessing settings."""
+        h = hashlib.sha256(f"{self.model}|{settings}|".encode())
+        if isinstance(item, Image.Image):
+            h.update(f"pil|{item.mode}|{item.size}|".encode())
+            h.update(item.tobytes())
+        elif isinstance(item, np.ndarray):
+            h.update(f"array|{item.dtype}|{item.shape}|".encode())
+            h.update(np.ascontiguousarray(item).tobytes())
+        elif os.path.isfile(item):
+            h.update(b"file|")
+            with open(item, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+        else:
+            h.update(b"text|")
+            h.update(item.encode())
+        return h.hexdigest()
+
+    def get(self, keys):
+        """Look up a list of keys. Returns a list with a float32 vector for each hit and None for each miss."""
+        with self.lock:
+            if any(k not in self.index for k in keys):
+                self._refresh()
+            return [
+                np.array(self.vectors[self.index[k]]) if k in self.index else None
+                for k in keys
+            ]
+
+    def put(self, keys, vectors):
+        """Add vectors to the cache. Keys that are already cached are skipped."""
+        with self.lock, self._file_lock():
+            self._refresh()
+            new = {}
+            for k, v in zip(keys, vectors):
+                if k not in self.index and k not in new:
+                    new[k] = v
+            if len(new) == 0:
+                return
+
+            needed = self.rows + len(new)
+            if needed > self.capacity:
+                self._map(max(needed, self.capacity * 2))
+
+            self.vectors[self.rows : needed] = np.asarray(list(new.values()), dtype=np.float32)
+            self.vectors.flush()
+            with self.key_path.open("ab") as f:
+                f.write("".join(f"{k}\n" for k in new.keys()).encode())
+            for row, k in enumerate(new.keys(), start=self.rows):
+                self.index[k] = row
+            self.rows = needed
+
+    def __len__(self):
+        return self.rows
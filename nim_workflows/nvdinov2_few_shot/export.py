@@ -0,0 +1,87 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def iter_collection(client, collection_name, output_fields, batch_size=1000, filter=""):
+    """Yield every row of a collection in batches of batch_size. Avoids the result size limit of a single query."""
+    iterator = client.query_iterator(
+        collection_name=collection_name,
+        batch_size=batch_size,
+        filter=filter,
+        output_fields=output_fields,
+    )
+    try:
+        while True:
+            batch = iterator.next()
+            if len(batch) == 0:
+                break
+            yield batch
+    finally:
+        iterator.close()
+
+
+def export_collection(
+    client,
+    collection_name,
+    out_prefix,
+    dim,
+    pk_field="id",
+    vector_field="vector",
+    metadata_fields=(),
+    batch_size=1000,
+):
+    """Stream a collection to <out_prefix>.vectors.f32 (row major float32) and <out_prefix>.meta.parquet (primary key and metadata).
+    Row i of the parquet file describes row i of the vectors. Returns the vectors as a read only memmap and the metadata as an arrow table."""
+    Path(out_prefix).parent.mkdir(parents=True, exist_ok=True)
+    vector_path = f"{out_prefix}.vectors.f32"
+    meta_path = f"{out_prefix}.meta.parquet"
+    columns = [pk_field] + list(metadata_fields)
+
+    writer = None
+    with open(vector_path, "wb") as vector_file:
+        for batch in iter_collection(
+            client, collection_name, columns + [vector_field], batch_size=batch_size
+        ):
+            np.asarray([x[vector_field] for x in batch], dtype=np.float32).tofile(vector_file)
+            table = pa.table({c: [x[c] for x in batch] for c in columns})
+            if writer is None:
+                writer = pq.ParquetWriter(meta_path, table.schema)
+            writer.write_table(table)
+
+    if writer is None:  # empty collection
+        pq.write_table(pa.table({c: [] for c in columns}), meta_path)
+    else:
+        writer.close()
+
+    return load_export(out_prefix, dim)
+
+
+def load_export(out_prefix, dim):
+    """Open a previous export without loading the vectors into memory"""
+    meta = pq.read_table(f"{out_prefix}.meta.parquet")
+    vector_path = f"{out_prefix}.vectors.f32"
+    if meta.num_rows == 0:
+        return np.zeros((0, dim), dtype=np.float32), meta
+    if os.path.getsize(vector_path) != meta.num_rows * dim * 4:
+        raise Exception(f"Export at {out_prefix} is incomplete")
+    vectors = np.memmap(vector_path, dtype=np.float32, mode="r", shape=(meta.num_rows, dim))
+    return vectors, meta
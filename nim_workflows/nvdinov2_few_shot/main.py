@@ -14,7 +14,6 @@
 # limitations under the License.
 
 from pathlib import Path
-from collections import Counter
 import argparse
 
 import gradio as gr
@@ -30,23 +29,31 @@ import itertools
 
 from nvclip import NVCLIP
 from nvdinov2 import NVDINOv2
+from export import export_collection
+from classifier import FewShotClassifier
 
 # global state
 embedding_model_g = None
 client_g = None
 classes_g = []
+classifier_g = None  # in memory copy of the support set used for classification
+image_path_of_id_g = {}
 
 
 def _update_plot(perplexity):
     """Generate plot based on latest vectors from db"""
     global client_g
 
-    # get all embeddings vectors from milvus
-    res = client_g.query(
-        collection_name="few_shot", output_fields=["vector", "class_label"], limit=1000
+    # stream all embedding vectors from milvus into a memory map
+    vectors, meta = export_collection(
+        client_g,
+        "few_shot",
+        "few_shot_export",
+        embedding_model_g.dim,
+        pk_field="sample_id",
+        metadata_fields=["class_label"],
     )
-    vectors = np.array([x["vector"] for x in res])
-    class_labels = np.array([x["class_label"] for x in res])
+    class_labels = np.array(meta.column("class_label").to_pylist())
 
     # Need atleast 2 vectors to plot
     if len(vectors) < 2:
@@ -95,7 +102,11 @@ def add_sample(sample, class_label):
             "image_path": sample[i],
         }
         data.append(data_sample)
-    client_g.insert(collection_name="few_shot", data=data)
+    result = client_g.insert(collection_name="few_shot", data=data)
+
+    # keep the classifier in sync with the db, using the db primary keys as sample ids
+    ids = classifier_g.add(response, class_label, ids=result["ids"])
+    image_path_of_id_g.update(zip(ids, sample))
 
     return _update_plot(7), None, None
 
@@ -119,29 +130,20 @@ def update_class_dropdown(evt: gr.EventData):
     return gr.Dropdown(choices=classes_g, interactive=True)
 
 
-def classify(sample, neighbors):
-    """Use KNN to classify new images"""
-    global client_g
+def classify(sample, neighbors, mode="KNN"):
+    """Classify a new image with the in memory classifier, either by a similarity weighted vote of its nearest neighbors or by the closest class prototype"""
+    if sample is None:
+        raise gr.Error("Upload an image to classify")
+    if len(classifier_g) == 0:
+        raise gr.Error("Add sample images before classifying")
 
     # embed sample
     embedding = embedding_model_g([sample])[0]
 
-    # get nearest neighbors
-    results = client_g.search(
-        collection_name="few_shot",
-        data=[embedding],
-        limit=neighbors,
-        output_fields=["class_label", "image_path"],
-    )
-
-    # determine majority class
-    labels = [x["entity"]["class_label"] for x in results[0]]
-    neighor_images = [x["entity"]["image_path"] for x in results[0]]
-    label_counter = Counter(labels)
-
-    # get label
-    label = label_counter.most_common()[0][0]
-    return label, neighor_images
+    labels, scores = classifier_g.predict([embedding], mode=mode.lower(), k=neighbors)
+    neighbor_ids, _ = classifier_g.kneighbors([embedding], k=neighbors)
+    neighbor_images = [image_path_of_id_g[id] for id in neighbor_ids[0].tolist()]
+    return f"{labels[0]} ({scores[0]:.2f})", neighbor_images
 
 
 def main(port):
@@ -211,7 +213,13 @@ def main(port):
             with gr.Column():
                 # classify options
                 inference_image_upload = gr.Image(type="filepath", label="Upload Image")
-                gr.Markdown("### KNN Classification Options")
+                gr.Markdown("### Classification Options")
+                mode_radio = gr.Radio(
+                    ["KNN", "Prototype"],
+                    value="KNN",
+                    label="Mode",
+                    info="KNN votes with the nearest samples weighted by similarity, Prototype picks the class with the closest mean embedding",
+                )
                 neighbor_slider = gr.Slider(
                     1,
                     50,
@@ -243,7 +251,7 @@ def main(port):
         )
         classify_btn.click(
             fn=classify,
-            inputs=[inference_image_upload, neighbor_slider],
+            inputs=[inference_image_upload, neighbor_slider, mode_radio],
             outputs=[classification_result, neighbor_gallery],
         )
 
@@ -265,16 +273,32 @@ if __name__ == "__main__":
     parser.add_argument(
         "--gradio_port", type=int, default=7860, help="Port to run Gradio UI"
     )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default="embedding_cache",
+        help="Folder to cache embeddings in so images are not re-embedded. Pass an empty string to disable",
+    )
+    parser.add_argument(
+        "--nvclip_url",
+        type=str,
+        default="https://integrate.api.nvidia.com/v1/embeddings",
+        help="URL to NV-CLIP NIM, or to a local embedding proxy that batches requests",
+    )
     args = parser.parse_args()
 
     # setup embedding model. NVCLIP or NVDINOv2
     if args.model == "nvclip":
-        embedding_model_g = NVCLIP(args.api_key)
+        embedding_model_g = NVCLIP(
+            args.api_key, base_url=args.nvclip_url, cache_dir=args.cache_dir or None
+        )
     elif args.model == "nvdinov2":
-        embedding_model_g = NVDINOv2(args.api_key)
+        embedding_model_g = NVDINOv2(args.api_key, cache_dir=args.cache_dir or None)
     else:
         raise Exception(f"Unsupported Embedding Model: {args.model}")
 
+    classifier_g = FewShotClassifier(embedding_model_g.dim)
+
     # remove db if it exists
     Path.unlink("./localdb.db", missing_ok=True)
 
@@ -13,8 +13,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import io 
-import requests, base64
 import os 
 from concurrent.futures import ThreadPoolExecutor
 from time import time 
@@ -23,35 +21,29 @@ import numpy as np
 from PIL import Image 
 from tqdm import tqdm 
 
+from preprocess import encode_image, ImagePreprocessor
+from embedding_cache import EmbeddingCache
+from concurrency import AdaptiveConcurrency, request_with_retry
+
 class NVCLIP:
 
-    def __init__(self, api_key, base_url="https://integrate.api.nvidia.com/v1/embeddings"):
-        """Initialize with NVCLIP url and API key"""
+    model = "nvidia/nvclip"
+    dim = 1024
+
+    def __init__(self, api_key, base_url="https://integrate.api.nvidia.com/v1/embeddings", preprocess_workers=0, cache_dir=None, controller=None):
+        """Initialize with NVCLIP url and API key. Set preprocess_workers to encode images on a process pool (None uses all CPUs, 0 encodes on the calling thread).
+        If cache_dir is given, embeddings are cached on disk by content and reused instead of sending a request.
+        controller is the AdaptiveConcurrency limit of the embedding endpoint, a new one is created if not given."""
         self.base_url = base_url
         self.api_key = api_key
         self.headers = {"Authorization": f"Bearer {self.api_key}", "Accept": "application/json"}
+        self.preprocessor = None if preprocess_workers == 0 else ImagePreprocessor(workers=preprocess_workers, bgr=False)
+        self.cache = None if cache_dir is None else EmbeddingCache(cache_dir, self.model, self.dim)
+        self.controller = AdaptiveConcurrency() if controller is None else controller
         
     def _encode_image(self, image, resize=True):
-        """ Resize image, encode as jpeg to shrink size then convert to b64 for upload """
-
-        if isinstance(image, str): #file path
-            image = Image.open(image).convert("RGB")
-        elif isinstance(image, Image.Image): #pil image 
-            image = image.convert("RGB")
-        elif isinstance(image, np.ndarray): #cv2 / np array image 
-            image = Image.fromarray(image)
-        else:
-            print(f"Unsupported image input: {type(image)}")
-            return None 
-            
-        if resize:
-            image = image.resize((336,336)) #could also centercrop or pad square and resize 
-
-        buf = io.BytesIO() #temporary buffer to save processed image 
-        image.save(buf, format="JPEG")
-        image = buf.getvalue()
-        image_b64 = base64.b64encode(image).decode()
-        return image_b64
+        """ Resize image, encode as jpeg to shrink size then convert to b64 for upload. np arrays are RGB in this workflow """
+        return encode_image(image, size=(336,336) if resize else None, bgr=False)
 
 
     def _combine_responses(self, responses):
@@ -77,8 +69,46 @@ class NVCLIP:
 
         return combined_responses
 
-    def __call__(self, items, chunk=64, workers=16, resize=True, return_meta=False):
-        """Embed images or text. Items should be a list of string or local filepaths to images. The items are chunked and spread across N worker threads. NVCLIP will accept upto 64 items in one request. """
+    def _merge_cached(self, keys, cached, miss_idx, response):
+        """Store newly embedded items in the cache and splice the cached hits back into one combined response."""
+        if response is None: #every item was cached 
+            usage = {"num_images": 0, "prompt_tokens": 0, "total_tokens": 0}
+            response = {"object":"list", "data":[], "usage":usage, "model":self.model}
+
+        self.cache.put([keys[i] for i in miss_idx], [data["embedding"] for data in response["data"]])
+        for i, data in zip(miss_idx, response["data"]):
+            cached[i] = data["embedding"]
+
+        response["data"] = [
+            {"object":"embedding", "index":i, "embedding":vector if isinstance(vector, list) else vector.tolist()}
+            for i, vector in enumerate(cached)
+        ]
+        return response
+
+    def __call__(self, items, chunk=64, workers=None, resize=True, return_meta=False):
+        """Embed images or text. Items should be a list of string or local filepaths to images. The items are chunked and spread across N worker threads. NVCLIP will accept upto 64 items in one request.
+        By default there is a thread per request the controller may allow, set workers to use fewer. """
+        workers = workers or self.controller.max_limit
+
+        if self.cache is None:
+            responses = self._embed_chunks(items, chunk, workers, resize)
+        else:
+            settings = "336x336" if resize else "original"
+            keys = [self.cache.key(item, settings) for item in items]
+            cached = self.cache.get(keys)
+            miss_idx = [i for i, vector in enumerate(cached) if vector is None]
+            responses = None
+            if len(miss_idx) > 0:
+                responses = self._embed_chunks([items[i] for i in miss_idx], chunk, workers, resize)
+            responses = self._merge_cached(keys, cached, miss_idx, responses)
+
+        if return_meta:
+            return  responses #embeddings and metadata
+        else:
+            return [x["embedding"] for x in responses["data"]] #just list of embeddings 
+
+    def _embed_chunks(self, items, chunk, workers, resize):
+        """Send all items to NVCLIP, chunk items per request and workers requests at a time."""
     
         with ThreadPoolExecutor(max_workers=workers) as executor:
 
@@ -87,25 +117,24 @@ class NVCLIP:
             print("Submitting Requests")
             for i in tqdm(range(0,len(items),chunk)):
                 item_chunk = items[i:min(len(items), i+chunk)] #each request will send chunk number of items 
-                embed_items = []
-                for item in item_chunk:
-                    if isinstance(item, (Image.Image, np.ndarray)) or os.path.isfile(item):
-                        embed_items.append(f"data:image/jpeg;base64,{self._encode_image(item, resize=resize)}") #image 
-                    else:
-                        embed_items.append(item) #string 
-                payload = {"input": embed_items, "model":"nvidia/nvclip"}
-                future = executor.submit(requests.post, self.base_url, headers=self.headers, json=payload)
+                embed_items = list(item_chunk)
+                image_idx = [j for j, item in enumerate(item_chunk) if isinstance(item, (Image.Image, np.ndarray)) or os.path.isfile(item)]
+                image_items = [item_chunk[j] for j in image_idx]
+                if self.preprocessor is not None:
+                    encoded = self.preprocessor.map(image_items, size=(336,336) if resize else None)
+                else:
+                    encoded = [self._encode_image(item, resize=resize) for item in image_items]
+                for j, image_b64 in zip(image_idx, encoded):
+                    embed_items[j] = f"data:image/jpeg;base64,{image_b64}" #image, strings are left as is 
+                payload = {"input": embed_items, "model":self.model}
+                future = executor.submit(request_with_retry, self.controller, "post", self.base_url, headers=self.headers, json=payload)
                 futures.append(future)
                 
             print("Collecting Responses")
             for future in tqdm(futures):
                     responses.append(future.result().json())
         
-        responses = self._combine_responses(responses)
-        if return_meta:
-            return  responses #embeddings and metadata
-        else:
-            return [x["embedding"] for x in responses["data"]] #just list of embeddings 
+        return self._combine_responses(responses)
 
 
 if __name__ == "__main__":
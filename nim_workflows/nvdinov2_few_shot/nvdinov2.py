@@ -14,35 +14,58 @@
 # limitations under the License.
 
 import io
-import requests
 import uuid
-from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import Thread, Lock
+from time import time
 
 from PIL import Image
 from tqdm import tqdm
 
+from embedding_cache import EmbeddingCache
+from concurrency import AdaptiveConcurrency, request_with_retry
+
 
 class NVDINOv2:
 
+    model = "nvidia/nv-dinov2"
+    dim = 1536
+
     def __init__(
-        self, api_key, base_url="https://ai.api.nvidia.com/v1/cv/nvidia/nv-dinov2"
+        self,
+        api_key,
+        base_url="https://ai.api.nvidia.com/v1/cv/nvidia/nv-dinov2",
+        cache_dir=None,
+        controller=None,
     ):
-        """Initialize with NVCLIP url and API key"""
+        """Initialize with NVDINOv2 url and API key. If cache_dir is given, embeddings are cached on disk by content and reused instead of sending a request.
+        controller limits the inference requests and can be shared with other NVDINOv2 clients. Asset creation and uploads have their own limits."""
         self.base_url = base_url
         self.api_key = api_key
         self.header_auth = f"Bearer {self.api_key}"
+        self.cache = (
+            None if cache_dir is None else EmbeddingCache(cache_dir, self.model, self.dim)
+        )
+        self.controller = AdaptiveConcurrency() if controller is None else controller
+        self.asset_controller = AdaptiveConcurrency()
+        self.upload_controller = AdaptiveConcurrency()
 
     def _combine_responses(self, responses):
         pass
 
-    def _upload_asset(self, image_path, description="input image"):
-        """
-        Uploads an asset to the NVCF API.
-        :param image_path: The image path
-        :param description: A description of the asset
+    def _encode(self, image):
+        """Convert an image path or PIL image to jpeg bytes for upload"""
+        if isinstance(image, str):
+            image = Image.open(image).convert("RGB")
+        elif isinstance(image, Image.Image):
+            image = image.convert("RGB")
 
-        """
+        buf = io.BytesIO()  # temporary buffer to save image
+        image.save(buf, format="JPEG")
+        return buf.getvalue()
 
+    def _create_asset(self, description="input image"):
+        """Create an NVCF asset. Returns the S3 upload url and the asset id."""
         assets_url = "https://api.nvcf.nvidia.com/v2/nvcf/assets"
 
         headers = {
@@ -50,43 +73,48 @@ class NVDINOv2:
             "Content-Type": "application/json",
             "accept": "application/json",
         }
+        payload = {"contentType": f"image/jpeg", "description": description}
+
+        response = request_with_retry(
+            self.asset_controller,
+            "post",
+            assets_url,
+            headers=headers,
+            json=payload,
+            timeout=30,
+        )
+        response.raise_for_status()
+        return response.json()["uploadUrl"], uuid.UUID(response.json()["assetId"])
 
+    def _put_asset(self, upload_url, data, description="input image"):
+        """Upload jpeg bytes to the S3 url of an asset"""
         s3_headers = {
             "x-amz-meta-nvcf-asset-description": description,
             "content-type": f"image/jpeg",
         }
-
-        payload = {"contentType": f"image/jpeg", "description": description}
-
-        response = requests.post(assets_url, headers=headers, json=payload, timeout=30)
-
-        response.raise_for_status()
-
-        asset_url = response.json()["uploadUrl"]
-        asset_id = response.json()["assetId"]
-
-        # Convert image to jpeg before uploading
-        if isinstance(image_path, str):
-            image = Image.open(image_path).convert("RGB")
-        elif isinstance(image_path, Image.Image):
-            image = image_path.convert("RGB")
-
-        buf = io.BytesIO()  # temporary buffer to save image
-        image.save(buf, format="JPEG")
-
-        # upload image
-        response = requests.put(
-            asset_url,
-            data=buf.getvalue(),
+        response = request_with_retry(
+            self.upload_controller,
+            "put",
+            upload_url,
+            data=data,
             headers=s3_headers,
             timeout=300,
         )
-
         response.raise_for_status()
-        return uuid.UUID(asset_id)
 
-    def _embed(self, image_path):
-        asset_id = self._upload_asset(image_path)
+    def _upload_asset(self, image_path, description="input image"):
+        """
+        Uploads an asset to the NVCF API.
+        :param image_path: The image path
+        :param description: A description of the asset
+
+        """
+        upload_url, asset_id = self._create_asset(description)
+        self._put_asset(upload_url, self._encode(image_path), description)
+        return asset_id
+
+    def _infer(self, asset_id):
+        """Embed an uploaded asset"""
         payload = {"messages": []}
         asset_list = f"{asset_id}"
 
@@ -97,29 +125,188 @@ class NVDINOv2:
             "Authorization": self.header_auth,
         }
 
-        response = requests.post(self.base_url, headers=headers, json=payload)
+        response = request_with_retry(
+            self.controller, "post", self.base_url, headers=headers, json=payload
+        )
+        response.raise_for_status()
 
         return response.json()
 
-    def __call__(self, image_paths, workers=16, return_meta=False):
-        """Embeds images provided as a list of file paths or PIL images. Will use multiple worker threads to submit simultaneous requests. Returns full metadata or just a list of embeddings"""
+    def _embed(self, image_path):
+        return self._infer(self._upload_asset(image_path))
+
+    def _split_cached(self, image_paths):
+        """Look up each image in the cache. Returns the cache keys, responses for the hits (None for a miss) and the indices of the misses."""
+        responses = [None] * len(image_paths)
+        keys = None
+        if self.cache is not None:
+            keys = [self.cache.key(x, "original jpeg") for x in image_paths]
+            for i, vector in enumerate(self.cache.get(keys)):
+                if vector is not None:
+                    responses[i] = {"metadata": [{"embedding": vector.tolist()}]}
+            print(
+                f"{sum(x is not None for x in responses)} of {len(image_paths)} embeddings found in cache"
+            )
+        miss_idx = [i for i, x in enumerate(responses) if x is None]
+        return keys, responses, miss_idx
+
+    def __call__(self, image_paths, workers=None, return_meta=False):
+        """Embeds images provided as a list of file paths or PIL images. Requests are sent through the staged pipeline of embed_many
+        with `workers` threads for upload and for inference (by default as many as the controllers allow). Returns full metadata or just a list of embeddings"""
+        return self.embed_many(
+            image_paths,
+            upload_workers=workers,
+            infer_workers=workers,
+            return_meta=return_meta,
+        )
+
+    def embed_many(
+        self,
+        image_paths,
+        encode_workers=4,
+        upload_workers=None,
+        infer_workers=None,
+        queue_size=32,
+        return_meta=False,
+        return_stats=False,
+        verbose=False,
+    ):
+        """Embed images with a staged pipeline. Each image is jpeg encoded once (encode stage), an asset is created and uploaded to S3
+        (upload stage) and the asset is embedded (infer stage). Every stage has its own worker threads and the stages are connected by
+        bounded queues, so all stages stay busy without one stage running far ahead of the next. A single image is embedded on the
+        calling thread and no stage gets more threads than there are images.
+        With return_stats=True also returns per stage latency statistics, verbose=True prints them. The upload and infer stages default
+        to the maximum limit of their controllers."""
 
         if isinstance(image_paths, str):
             image_paths = [image_paths]
+        upload_workers = upload_workers or max(self.asset_controller.max_limit, self.upload_controller.max_limit)
+        infer_workers = infer_workers or self.controller.max_limit
+
+        keys, responses, miss_idx = self._split_cached(image_paths)
+        stats = {name: _StageStats(name) for name in ("encode", "upload", "infer")}
+        errors = {}
 
-        with ThreadPoolExecutor(max_workers=workers) as executor:
-            responses = []
-            futures = []
-            print("submitting requests")
-            for i in tqdm(range(0, len(image_paths))):
-                future = executor.submit(self._embed, image_paths[i])
-                futures.append(future)
-
-            print("collecting responses")
-            for future in tqdm(futures):
-                if return_meta:
-                    responses.append(future.result())
-                else:
-                    responses.append(future.result()["metadata"][0]["embedding"])
-
-        return responses
+        encoded_q = Queue(maxsize=queue_size)
+        uploaded_q = Queue(maxsize=queue_size)
+        todo_q = Queue()
+        for i in miss_idx:
+            todo_q.put(i)
+
+        def stage(name, get, work, put):
+            while True:
+                item = get()
+                if item is None:
+                    return
+                i, value = item
+                start = time()
+                try:
+                    result = work(value)
+                except Exception as e:  # the image is dropped, the error is raised once the pipeline is drained
+                    errors[i] = e
+                    continue
+                stats[name].add(time() - start)
+                put((i, result))
+
+        def next_todo():
+            try:
+                i = todo_q.get_nowait()
+            except Empty:
+                return None
+            return i, image_paths[i]
+
+        def upload(data):
+            upload_url, asset_id = self._create_asset()
+            self._put_asset(upload_url, data)
+            return asset_id
+
+        def store(item):
+            responses[item[0]] = item[1]
+            progress.update(1)
+
+        if len(miss_idx) == 1:  # e.g. classify, starting the stage threads would cost more than the request
+            i = miss_idx[0]
+            value = image_paths[i]
+            try:
+                for name, work in (("encode", self._encode), ("upload", upload), ("infer", self._infer)):
+                    start = time()
+                    value = work(value)
+                    stats[name].add(time() - start)
+                responses[i] = value
+            except Exception as e:
+                errors[i] = e
+        else:
+            stages = [
+                (min(encode_workers, len(miss_idx)), "encode", next_todo, self._encode, encoded_q),
+                (min(upload_workers, len(miss_idx)), "upload", encoded_q.get, upload, uploaded_q),
+                (min(infer_workers, len(miss_idx)), "infer", uploaded_q.get, self._infer, None),
+            ]
+            with tqdm(total=len(miss_idx)) as progress:
+                threads = []
+                for workers, name, get, work, out_q in stages:
+                    put = store if out_q is None else out_q.put
+                    stage_threads = [
+                        Thread(target=stage, args=(name, get, work, put), daemon=True)
+                        for _ in range(workers)
+                    ]
+                    for thread in stage_threads:
+                        thread.start()
+                    threads.append(stage_threads)
+
+                # shut the stages down in order. A stage is finished once all its threads returned, then the next stage gets one stop marker per thread
+                for (_, _, _, _, out_q), stage_threads, (next_workers, *_) in zip(stages, threads, stages[1:]):
+                    for thread in stage_threads:
+                        thread.join()
+                    for _ in range(next_workers):
+                        out_q.put(None)
+                for thread in threads[-1]:
+                    thread.join()
+
+        summary = {name: x.summary() for name, x in stats.items()}
+        if verbose:
+            print(
+                "  ".join(
+                    f"{name}: {x['count']} in {x['mean_ms']:.0f}ms avg, {x['p99_ms']:.0f}ms p99"
+                    for name, x in summary.items()
+                )
+            )
+        if len(errors) > 0:
+            raise Exception(
+                f"{len(errors)} of {len(miss_idx)} images failed to embed. First error: {next(iter(errors.values()))}"
+            )
+
+        if self.cache is not None:
+            self.cache.put(
+                [keys[i] for i in miss_idx],
+                [responses[i]["metadata"][0]["embedding"] for i in miss_idx],
+            )
+
+        results = responses if return_meta else [x["metadata"][0]["embedding"] for x in responses]
+        if return_stats:
+            return results, summary
+        return results
+
+
+class _StageStats:
+    """Latencies of one pipeline stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.lock = Lock()
+
+    def add(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        n = len(latencies)
+        if n == 0:
+            return {"count": 0, "mean_ms": 0.0, "p50_ms": 0.0, "p99_ms": 0.0}
+        return {
+            "count": n,
+            "mean_ms": 1000 * sum(latencies) / n,
+            "p50_ms": 1000 * latencies[int(0.5 * (n - 1))],
+            "p99_ms": 1000 * latencies[int(0.99 * (n - 1))],
+        }
@@ -20,7 +20,6 @@
 import os
 import sys
 import zipfile
-import requests
 import io
 from PIL import Image
 import uuid
@@ -28,15 +27,24 @@ from pathlib import Path
 import json
 import tempfile
 
+from concurrency import AdaptiveConcurrency, request_with_retry
+
 
 class Florence:
 
     def __init__(
-        self, api_key, base_url="https://ai.api.nvidia.com/v1/vlm/microsoft/florence-2"
+        self,
+        api_key,
+        base_url="https://ai.api.nvidia.com/v1/vlm/microsoft/florence-2",
+        controller=None,
     ):
+        """Provide an API key. controller limits the Florence-2 inference requests, uploads are limited separately."""
         self.api_key = api_key
         self.base_url = base_url
         self.header_auth = f"Bearer {self.api_key}"
+        self.controller = AdaptiveConcurrency() if controller is None else controller
+        self.asset_controller = AdaptiveConcurrency()
+        self.upload_controller = AdaptiveConcurrency()
 
     def _upload_asset(self, image_path, description):
         """
@@ -60,7 +68,14 @@ class Florence:
 
         payload = {"contentType": f"image/jpeg", "description": description}
 
-        response = requests.post(assets_url, headers=headers, json=payload, timeout=30)
+        response = request_with_retry(
+            self.asset_controller,
+            "post",
+            assets_url,
+            headers=headers,
+            json=payload,
+            timeout=30,
+        )
 
         response.raise_for_status()
 
@@ -73,7 +88,9 @@ class Florence:
         image.save(buf, format="JPEG")
 
         # upload image
-        response = requests.put(
+        response = request_with_retry(
+            self.upload_controller,
+            "put",
             asset_url,
             data=buf.getvalue(),
             headers=s3_headers,
@@ -115,7 +132,9 @@ class Florence:
         }
 
         # Send the request to the NIM API.
-        response = requests.post(self.base_url, headers=headers, json=payload)
+        response = request_with_retry(
+            self.controller, "post", self.base_url, headers=headers, json=payload
+        )
 
         with tempfile.TemporaryDirectory() as temp_dir:
             zip_path = Path(temp_dir) / "result.zip"
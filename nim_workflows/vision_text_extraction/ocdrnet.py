@@ -21,16 +21,25 @@ import zipfile
 from pathlib import Path
 from PIL import Image
 import tempfile
-import requests
 
+from concurrency import AdaptiveConcurrency, request_with_retry
 
-class OCDRNET:
 
-    def __init__(self, api_key, url="https://ai.api.nvidia.com/v1/cv/nvidia/ocdrnet"):
+class OCDRNET:
 
+    def __init__(
+        self,
+        api_key,
+        url="https://ai.api.nvidia.com/v1/cv/nvidia/ocdrnet",
+        controller=None,
+    ):
+        """Provide an API key. controller limits the OCDRNet inference requests, uploads are limited separately."""
         self.api_key = api_key
         self.url = url
         self.header_auth = f"Bearer {self.api_key}"
+        self.controller = AdaptiveConcurrency() if controller is None else controller
+        self.asset_controller = AdaptiveConcurrency()
+        self.upload_controller = AdaptiveConcurrency()
 
     def _upload_asset(self, image_path, description):
         """
@@ -55,7 +64,14 @@ class OCDRNET:
 
         payload = {"contentType": f"image/jpeg", "description": description}
 
-        response = requests.post(assets_url, headers=headers, json=payload, timeout=30)
+        response = request_with_retry(
+            self.asset_controller,
+            "post",
+            assets_url,
+            headers=headers,
+            json=payload,
+            timeout=30,
+        )
 
         response.raise_for_status()
 
@@ -68,7 +84,9 @@ class OCDRNET:
         image.save(buf, format="JPEG")
 
         # upload image
-        response = requests.put(
+        response = request_with_retry(
+            self.upload_controller,
+            "put",
             asset_url,
             data=buf.getvalue(),
             headers=s3_headers,
@@ -97,7 +115,9 @@ class OCDRNET:
             "Authorization": self.header_auth,
         }
 
-        response = requests.post(self.url, headers=headers, json=inputs)
+        response = request_with_retry(
+            self.controller, "post", self.url, headers=headers, json=inputs
+        )
 
         if output_folder:
             zip_path = Path(output_folder) / (Path(image_path).stem + ".zip")
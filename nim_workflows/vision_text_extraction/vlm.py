@@ -17,13 +17,17 @@ import io
 import base64
 import uuid
 from PIL import Image
-import requests
+
+from concurrency import AdaptiveConcurrency, request_with_retry
 
 
 class VLM:
-    def __init__(self, url, api_key):
-        """Provide NIM API URL and an API key"""
+    def __init__(self, url, api_key, controller=None):
+        """Provide NIM API URL and an API key. Pass the controller of another VLM client to share its request limit."""
         self.api_key = api_key
+        self.controller = AdaptiveConcurrency() if controller is None else controller
+        self.asset_controller = AdaptiveConcurrency()
+        self.upload_controller = AdaptiveConcurrency()
         self.model = url.split("/")[-2:]
         self.model = "/".join(self.model)
         # llama URLs are slightly different from other VLMs
@@ -62,7 +66,14 @@ class VLM:
 
         payload = {"contentType": f"image/jpeg", "description": description}
 
-        response = requests.post(assets_url, headers=headers, json=payload, timeout=30)
+        response = request_with_retry(
+            self.asset_controller,
+            "post",
+            assets_url,
+            headers=headers,
+            json=payload,
+            timeout=30,
+        )
 
         response.raise_for_status()
 
@@ -75,7 +86,9 @@ class VLM:
         image.save(buf, format="JPEG")
 
         # upload image
-        response = requests.put(
+        response = request_with_retry(
+            self.upload_controller,
+            "put",
             asset_url,
             data=buf.getvalue(),
             headers=s3_headers,
@@ -113,7 +126,9 @@ class VLM:
         }
         if system_prompt:
             payload["messages"].insert(0, {"role": "system", "content": system_prompt})
-        response = requests.post(self.url, headers=headers, json=payload)
+        response = request_with_retry(
+            self.controller, "post", self.url, headers=headers, json=payload
+        )
         print(response)
         print(response.text)
         response = response.json()
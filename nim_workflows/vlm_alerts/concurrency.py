@@ -0,0 +1,189 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from threading import Condition
+from time import time
+from email.utils import parsedate_to_datetime
+
+import requests
+
+RETRY_STATUS = (429, 503)
+
+
+class AdaptiveConcurrency:
+
+    def __init__(
+        self,
+        initial=4,
+        min_limit=1,
+        max_limit=64,
+        latency_tolerance=2.0,
+        backoff=0.5,
+    ):
+        """AIMD limit on the number of requests in flight. The limit grows while request latency stays within latency_tolerance times the fastest
+        latency seen and is multiplied by backoff when the endpoint returns 429/503. A single instance can be shared by several clients hitting the same endpoint,
+        the clients of this repo take it as their controller argument. Endpoints with very different latencies, such as NVCF asset creation, S3
+        uploads and inference, each need their own instance. Thread pools should have max_limit threads and leave the number of requests in flight to the controller.
+        """
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+
+        self.in_flight = 0
+        self.min_latency = None
+        self.slow_start = True  # grow by 1 per success until the first sign of overload
+        self.resume_at = 0.0  # no new requests before this time (from Retry-After)
+        self.last_decrease = 0.0
+        self.cond = Condition()
+        self.async_waiters = []  # (event loop, asyncio.Event) of coroutines blocked in acquire_async
+
+    def _wait_time(self):
+        """Seconds until a new request may start. 0 if one can start now. Must hold the lock."""
+        wait = self.resume_at - time()
+        if wait > 0:
+            return wait
+        if self.in_flight < int(self.limit):
+            return 0
+        return None  # wait for a release
+
+    def acquire(self):
+        """Block until a request slot is free."""
+        with self.cond:
+            while True:
+                wait = self._wait_time()
+                if wait == 0:
+                    break
+                self.cond.wait(wait)
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        """Same as acquire but yields to the event loop while waiting. The controller is shared with threads, so each waiter registers an
+        event under the lock and release sets it from whichever thread frees the slot. A release can not be missed between check and wait."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.cond:
+                wait = self._wait_time()
+                if wait == 0:
+                    self.in_flight += 1
+                    return
+                waiter = (loop, asyncio.Event())
+                self.async_waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter[1].wait(), wait)
+            except asyncio.TimeoutError:  # Retry-After delay is over
+                pass
+            finally:
+                with self.cond:
+                    if waiter in self.async_waiters:
+                        self.async_waiters.remove(waiter)
+
+    def _notify(self):
+        """Wake all blocked acquires. Must hold the lock."""
+        self.cond.notify_all()
+        for loop, event in self.async_waiters:
+            loop.call_soon_threadsafe(event.set)
+        self.async_waiters = []
+
+    def _decrease(self):
+        # only back off once per round trip, otherwise a burst of 429s from one window would collapse the limit
+        window = self.min_latency if self.min_latency is not None else 1.0
+        if time() - self.last_decrease > window:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+            self.last_decrease = time()
+        self.slow_start = False
+
+    def release(self, latency=None, throttled=False, retry_after=None):
+        """Return a slot. Pass the request latency on success, or throttled=True and the Retry-After delay when the endpoint pushed back.
+        Without either (errors, cancelled requests) the limit is left unchanged."""
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                self._decrease()
+                if retry_after is not None:
+                    self.resume_at = max(self.resume_at, time() + retry_after)
+            elif latency is not None:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                if latency <= self.latency_tolerance * self.min_latency:
+                    step = 1 if self.slow_start else 1 / self.limit
+                    self.limit = min(self.max_limit, self.limit + step)
+                else:
+                    self.slow_start = False
+            self._notify()
+
+
+def _retry_after(headers, attempt):
+    """Parse Retry-After as seconds or an HTTP date, falling back to exponential backoff."""
+    value = headers.get("Retry-After")
+    if value is not None:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+            except (TypeError, ValueError):
+                pass
+    return min(60.0, 0.5 * 2**attempt)
+
+
+def request_with_retry(controller, method, url, session=None, max_retries=5, **kwargs):
+    """Send a request within the controller's concurrency limit. 429/503 responses shrink the limit and the request is retried after Retry-After.
+    Returns the requests.Response. Other error codes are returned to the caller unchanged and do not count as a success."""
+    sender = requests if session is None else session
+    for attempt in range(max_retries + 1):
+        controller.acquire()
+        start = time()
+        try:
+            response = sender.request(method, url, **kwargs)
+        except Exception:
+            controller.release()
+            raise
+
+        if response.status_code not in RETRY_STATUS:
+            controller.release(latency=None if response.status_code >= 400 else time() - start)
+            return response
+
+        delay = _retry_after(response.headers, attempt)
+        controller.release(throttled=True, retry_after=delay)
+        if attempt == max_retries:
+            break
+        # the next acquire waits out the delay, along with every other request on this controller
+
+    response.raise_for_status()
+
+
+async def request_with_retry_async(controller, session, method, url, max_retries=5, **kwargs):
+    """Async version of request_with_retry for an aiohttp session. Returns the parsed json body."""
+    for attempt in range(max_retries + 1):
+        await controller.acquire_async()
+        start = time()
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                if response.status not in RETRY_STATUS:
+                    response.raise_for_status()
+                    body = await response.json()
+                    controller.release(latency=time() - start)
+                    return body
+                delay = _retry_after(response.headers, attempt)
+                if attempt == max_retries:
+                    response.raise_for_status()
+        except BaseException:  # includes task cancellation
+            controller.release()
+            raise
+
+        controller.release(throttled=True, retry_after=delay)
@@ -0,0 +1,49 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import base64
+
+import numpy as np
+from PIL import Image
+
+
+def encode_image(image, size=(336, 336), quality=75, bgr=True):
+    """Resize image, encode as jpeg to shrink size then convert to b64 for upload. Set size to None to keep the original resolution.
+    bgr sets the channel order of np array inputs: True for cv2 frames, False for RGB arrays."""
+
+    if isinstance(image, str):  # file path
+        image = Image.open(image)
+        if size is not None:
+            # let the jpeg decoder downscale by a power of 2 while decoding. Only applies to jpegs and never goes below size
+            image.draft("RGB", size)
+        image = image.convert("RGB")
+    elif isinstance(image, Image.Image):  # pil image
+        image = image.convert("RGB")
+    elif isinstance(image, np.ndarray):  # cv2 / np array image
+        if bgr and image.ndim == 3:
+            image = image[:, :, ::-1]  # BGR to RGB
+        image = Image.fromarray(np.ascontiguousarray(image)).convert("RGB")
+    else:
+        print(f"Unsupported image input: {type(image)}")
+        return None
+
+    if size is not None:
+        image = image.resize(size)  # could also centercrop or pad square and resize
+
+    buf = io.BytesIO()  # temporary buffer to save processed image
+    image.save(buf, format="JPEG", quality=quality)
+    return base64.b64encode(buf.getvalue()).decode()
+
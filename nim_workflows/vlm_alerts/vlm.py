@@ -13,17 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import numpy as np
-import cv2
 from threading import Thread
-from PIL import Image
-import io
-import requests, base64
+
+from preprocess import encode_image
+from concurrency import AdaptiveConcurrency, request_with_retry
 
 
 class VLM:
 
-    def __init__(self, url, api_key, callback, model_name=None):
+    def __init__(self, url, api_key, callback, model_name=None, controller=None):
         if model_name is None:  # preview VLM APIs have the model in the URL
             self.model = url.split("/")[-2:]
             self.model = "/".join(self.model)
@@ -43,28 +41,13 @@ class VLM:
         self.reply = ""
         self.api_key = api_key
         self.callback = callback
+        self.controller = AdaptiveConcurrency() if controller is None else controller
 
     def _encode_image(self, image):
         """Resize image, encode as jpeg to shrink size then convert to b64 for upload"""
-
-        if isinstance(image, str):  # file path
-            image = Image.open(image).convert("RGB")
-        elif isinstance(image, Image.Image):  # pil image
-            image = image.convert("RGB")
-        elif isinstance(image, np.ndarray):  # cv2 / np array image
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            image = Image.fromarray(image)
-        else:
-            print(f"Unsupported image input: {type(image)}")
+        image_b64 = encode_image(image, size=(336, 336))
+        if image_b64 is None:
             return None
-
-        image = image.resize(
-            (336, 336)
-        )  # centercrop or pad square then resize are other strategies
-        buf = io.BytesIO()  # temporary buffer to save processed image
-        image.save(buf, format="JPEG")
-        image = buf.getvalue()
-        image_b64 = base64.b64encode(image).decode()
         assert len(image_b64) < 180_000, "Image too large to upload."
         return image_b64
 
@@ -91,7 +74,9 @@ class VLM:
                 "model": self.model,
             }
 
-            response = requests.post(self.url, headers=headers, json=payload)
+            response = request_with_retry(
+                self.controller, "post", self.url, headers=headers, json=payload
+            )
             print(response.status_code)
             print(response.text)
             self.reply = response.json()["choices"][0]["message"]["content"]